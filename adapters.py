@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package adapters.py
+
+Shares the sensor fleet between one or more Bluetooth adapters, assigning
+each sensor to the adapter that reaches it best and keeping the adapters'
+workloads balanced. The adapters reach the sensors through a backend from
+backends.py.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+import asyncio
+
+class AdapterConstants:
+    """
+    Class to provide constant values for adapter scheduling
+    """
+    # Latency assumed for a sensor an adapter has never read from
+    DEFAULT_LATENCY_S       = 10.0
+    # Weight given to the newest sample in the latency average
+    LATENCY_ALPHA           = 0.3
+    # Weight given to the newest read in the success rate, so a link
+    # recovers from a bad spell after a few good reads
+    SUCCESS_ALPHA           = 0.3
+    # Success rate below which a sensor is offered to another adapter
+    MIN_SUCCESS_RATE        = 0.5
+    # Reads required before the success rate is trusted
+    MIN_SAMPLES             = 3
+    # Heaviest/lightest expected load ratio that triggers a rebalance
+    REBALANCE_RATIO         = 1.5
+
+class LinkStats:
+    """
+    Observed quality of the link between one adapter and one sensor
+    """
+
+    def __init__(self):
+        """
+        Constructs empty link statistics
+        """
+        self.latency = None
+        self.reads = 0
+        self.success = 1.0
+
+    def record(self, latency, ok):
+        """
+        Records the outcome of a single read
+        """
+        self.reads += 1
+        alpha = AdapterConstants.SUCCESS_ALPHA
+        self.success = alpha * (1.0 if ok else 0.0) + (1 - alpha) * self.success
+        if ok:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                alpha = AdapterConstants.LATENCY_ALPHA
+                self.latency = alpha * latency + (1 - alpha) * self.latency
+
+    def success_rate(self):
+        """
+        Gets the recent fraction of reads that succeeded, weighted towards
+        the newest, 1.0 if none were made
+        """
+        return self.success
+
+    def is_poor(self):
+        """
+        Whether enough reads have failed to look for a better adapter
+        """
+        return self.reads >= AdapterConstants.MIN_SAMPLES and \
+            self.success_rate() < AdapterConstants.MIN_SUCCESS_RATE
+
+    def expected_cost(self, default):
+        """
+        Gets the expected time to complete a read, including retries
+        """
+        latency = default if self.latency is None else self.latency
+        return latency / max(self.success_rate(), 0.1)
+
+class Adapter:
+    """
+    Adapter class - Reads and discovers sensors through a single adapter
+    """
+
+    def __init__(self, name, backend, max_connections=1):
+        """
+        Constructs the adapter, where name is the interface name, e.g. hci0
+        """
+        self.name = name
+        self.backend = backend
+        self.max_connections = max(1, max_connections)
+        self.assigned = set()
+        self.links = {}
+        # Sensors this adapter heard while scanning
+        self.heard = set()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name}, {len(self.assigned)} sensors)"
+
+    def link(self, addr):
+        """
+        Gets the link statistics for the given sensor address
+        """
+        if addr not in self.links:
+            self.links[addr] = LinkStats()
+        return self.links[addr]
+
+    def mean_latency(self):
+        """
+        Gets the mean observed latency over all sensors read by this adapter
+        """
+        latencies = [l.latency for l in self.links.values() if l.latency is not None]
+        if len(latencies):
+            return sum(latencies) / len(latencies)
+        return AdapterConstants.DEFAULT_LATENCY_S
+
+    def cost(self, addr):
+        """
+        Gets the expected cost of reading the given sensor on this adapter
+        """
+        default = self.mean_latency()
+        if addr in self.links:
+            return self.links[addr].expected_cost(default)
+        return default
+
+    def expected_load(self, extra=None):
+        """
+        Gets the expected cycle time for the assigned sensors, optionally
+        including an extra sensor address
+        """
+        addrs = self.assigned if extra is None else self.assigned | {extra}
+        return sum(self.cost(a) for a in addrs) / self.max_connections
+
+    async def discover(self, existing, duration):
+        """
+        Scans for new Xiaomi devices through this adapter
+        """
+        return await self.backend.discover(self.name, existing, duration)
+
+    async def read(self, addr, since=None):
+        """
+        Reads a single sensor through this adapter, returning a ReadResult,
+        including any on-device history after since
+        """
+        return await self.backend.read(self.name, addr, since)
+
+class AdapterScheduler:
+    """
+    AdapterScheduler class - Assigns sensors to adapters and runs each
+    adapter's share of a reading cycle in parallel
+    """
+
+    def __init__(self, adapters):
+        """
+        Constructs the scheduler for the given adapters
+        """
+        if not len(adapters):
+            raise Exception("At least one adapter is required.")
+        self.adapters = adapters
+
+    @staticmethod
+    def from_settings(entries, backend):
+        """
+        Creates a scheduler from the 'adapters' settings list, with every
+        adapter using the given backend
+        """
+        adapters = []
+        for entry in entries:
+            adapters.append(Adapter(
+                entry['name'],
+                backend,
+                entry.get('max_connections', 1)
+            ))
+        return AdapterScheduler(adapters)
+
+    def adapter_for(self, addr):
+        """
+        Gets the adapter the given sensor is assigned to, if any
+        """
+        for adapter in self.adapters:
+            if addr in adapter.assigned:
+                return adapter
+        return None
+
+    def reaches(self, adapter, addr):
+        """
+        Whether the adapter is expected to reach the given sensor: it heard
+        the sensor while scanning, or no adapter did
+        """
+        return addr in adapter.heard or \
+            not any(addr in a.heard for a in self.adapters)
+
+    def best_adapter(self, addr, exclude=None):
+        """
+        Gets the adapter which would finish its cycle soonest if it were
+        also given the given sensor, preferring those which heard it
+        """
+        candidates = [a for a in self.adapters if a is not exclude]
+        if not len(candidates):
+            return None
+        heard = [a for a in candidates if addr in a.heard]
+        if len(heard):
+            candidates = heard
+        return min(candidates, key=lambda a: a.expected_load(addr))
+
+    def assign(self, addrs):
+        """
+        Assigns any sensors not yet owned by an adapter, and drops
+        assignments for sensors no longer present
+        """
+        addrs = set(addrs)
+        for adapter in self.adapters:
+            adapter.assigned &= addrs
+        for addr in sorted(addrs):
+            if self.adapter_for(addr) is None:
+                self.best_adapter(addr).assigned.add(addr)
+
+    def move(self, addr, source, target):
+        """
+        Moves a sensor from one adapter to another
+        """
+        source.assigned.discard(addr)
+        target.assigned.add(addr)
+        print(f"Moved {addr} from {source.name} to {target.name}")
+
+    def rebalance(self):
+        """
+        Moves sensors away from adapters that read them poorly, then evens
+        out the expected load between adapters
+        """
+        if len(self.adapters) < 2:
+            return
+        for adapter in self.adapters:
+            for addr in sorted(adapter.assigned):
+                if adapter.link(addr).is_poor():
+                    target = self.best_adapter(addr, exclude=adapter)
+                    if not target.link(addr).is_poor():
+                        self.move(addr, adapter, target)
+
+        # Greedily move the sensor that best relieves the heaviest adapter,
+        # stopping as soon as no move would lower the peak load
+        for _ in range(sum(len(a.assigned) for a in self.adapters)):
+            heaviest = max(self.adapters, key=lambda a: a.expected_load())
+            lightest = min(self.adapters, key=lambda a: a.expected_load())
+            peak = heaviest.expected_load()
+            if peak <= AdapterConstants.REBALANCE_RATIO * lightest.expected_load():
+                break
+            best = None
+            for addr in heaviest.assigned:
+                if lightest.link(addr).is_poor() or not self.reaches(lightest, addr):
+                    continue
+                new_peak = max(
+                    heaviest.expected_load() - heaviest.cost(addr) / heaviest.max_connections,
+                    lightest.expected_load(addr)
+                )
+                if new_peak < peak and (best is None or new_peak < best[1]):
+                    best = (addr, new_peak)
+            if best is None:
+                break
+            self.move(best[0], heaviest, lightest)
+
+    async def discover(self, existing, duration):
+        """
+        Scans on all adapters in parallel, returning the merged new devices
+        renumbered so that names stay unique
+        """
+        results = await asyncio.gather(
+            *[a.discover(existing, duration) for a in self.adapters],
+            return_exceptions=True
+        )
+        found = {}
+        for adapter, result in zip(self.adapters, results):
+            if isinstance(result, Exception):
+                print(f"Scanning on {adapter.name} failed: {result}")
+                continue
+            for addr, device in result.items():
+                adapter.heard.add(addr)
+                found.setdefault(addr, device)
+        next_index = len(existing) + 1
+        for addr in sorted(found):
+            found[addr]['sensor_name'] = "Sensor %02d" % next_index
+            next_index += 1
+        return found
+
+    async def run_cycle(self, addrs, read_sensor):
+        """
+        Runs one reading cycle. read_sensor is a coroutine function taking
+        the adapter and the sensor address; each adapter reads up to its
+        max_connections sensors at a time.
+        """
+        self.assign(addrs)
+
+        async def run_adapter(adapter):
+            semaphore = asyncio.Semaphore(adapter.max_connections)
+
+            async def run_one(addr):
+                async with semaphore:
+                    await read_sensor(adapter, addr)
+
+            await asyncio.gather(*[run_one(a) for a in sorted(adapter.assigned)])
+
+        await asyncio.gather(*[run_adapter(a) for a in self.adapters])
+        self.rebalance()
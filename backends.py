@@ -0,0 +1,653 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package backends.py
+
+Bluetooth backends for discovering and reading the Xiaomi sensors. The HCI
+backend talks to real hardware, the simulated backend provides a fleet of
+virtual sensors so the server can be exercised without any, and the replay
+backend plays recorded history files back faster than real time.
+
+The Bluetooth libraries are only imported by the HCI backend when it is first
+used, so the simulated backend runs on machines without them.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from glob import glob
+from json import loads
+from os import path
+from random import Random
+from time import monotonic
+from metrics import metrics
+from migrate_histories import recover_records, valid_record
+import asyncio
+
+class ExitCodes:
+    OK = 0
+    INVALID_ARGS = 1
+    USER_CANCELLED = 2
+    TIMED_OUT = 3
+    DISCONNECTED = 4
+    UNKNOWN_ERROR = 5
+
+    @staticmethod
+    def name(code):
+        """
+        Gets the name of the given exit code
+        """
+        for name, value in vars(ExitCodes).items():
+            if value == code and name.isupper():
+                return name
+        return str(code)
+
+class BackendConstants:
+    """
+    Class to provide constant values for the backends
+    """
+    TEMP_HUM_DEV_ADDR_START = "A4:C1:38"
+    TEMP_HUM_DEV_NAME       = "LYWSD03MMC"
+    READ_TIMEOUT_S          = 180
+    DISCOVER_TIMEOUT_S      = 180
+    # Hours of records a sensor keeps in its on-device history
+    DEVICE_HISTORY_HOURS    = 24 * 7
+    # Replayed sensors are given locally administered addresses starting
+    # with this, which no real sensor has, so their history files never
+    # overwrite the recordings
+    REPLAY_ADDR_START       = "02:00:00"
+    # Day zero of the timestamps written by history_to_csv.py
+    EXCEL_EPOCH             = datetime(1899, 12, 30)
+
+def is_xiaomi_device(addr, name):
+    """
+    Whether the given address and name belong to a Xiaomi sensor
+    """
+    return addr[:len(BackendConstants.TEMP_HUM_DEV_ADDR_START)] == \
+        BackendConstants.TEMP_HUM_DEV_ADDR_START or \
+        name == BackendConstants.TEMP_HUM_DEV_NAME
+
+def new_device(addr, name, index):
+    """
+    Creates the record for a newly discovered device
+    """
+    return {
+        'dev_name': name,
+        'addr': addr,
+        'sensor_name': "Sensor %02d" % index,
+        'history_file': f'sensor_{addr.replace(":", "")}_history.json',
+        'active': True,
+        'last_reading': None
+    }
+
+def new_devices(found, existing):
+    """
+    Creates records for the Xiaomi devices in found (address -> name) that
+    are not in existing
+    """
+    x_devices = {}
+    next_index = len(existing) + 1
+    for addr, name in found.items():
+        if is_xiaomi_device(addr, name) and addr not in existing:
+            x_devices[addr] = new_device(addr, name, next_index)
+            next_index += 1
+    return x_devices
+
+def history_reading(timestamp, min_temp, min_hum, max_temp, max_hum):
+    """
+    Converts an on-device history record, which holds the minimum and
+    maximum over an hour, into a history reading
+    """
+    return {
+        'timestamp': timestamp.isoformat(),
+        'temperature': round((min_temp + max_temp) / 2, 1),
+        'humidity': (min_hum + max_hum) // 2,
+        'battery': None,
+        'temperature_min': min_temp,
+        'temperature_max': max_temp,
+        'humidity_min': min_hum,
+        'humidity_max': max_hum,
+        'source': 'device'
+    }
+
+class ReadResult:
+    """
+    The outcome of reading a single sensor
+    """
+
+    def __init__(self, code, reading=None, connect_seconds=None,
+        read_seconds=None, history=None, earlier=None):
+        """
+        Constructs the result from an ExitCodes value and, if successful,
+        the reading. The timings are None where the backend cannot tell.
+        history holds any on-device history readings that were requested,
+        and earlier any readings taken since the sensor was last read,
+        before the reading, oldest first.
+        """
+        self.code = code
+        self.reading = reading
+        self.connect_seconds = connect_seconds
+        self.read_seconds = read_seconds
+        self.history = history or []
+        self.earlier = earlier or []
+
+class BleBackend:
+    """
+    BleBackend class - The interface every backend provides. Interfaces are
+    named after the adapter, e.g. hci0.
+    """
+
+    async def discover(self, interface, existing, duration):
+        """
+        Scans for duration seconds, returning records for the Xiaomi devices
+        found that are not in existing
+        """
+        raise NotImplementedError()
+
+    async def read(self, interface, addr, since=None):
+        """
+        Connects to the given sensor, takes a reading and disconnects,
+        returning a ReadResult. If since is given, the on-device history
+        records after that time are fetched over the same connection.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def from_settings(settings):
+        """
+        Creates the backend described by the 'backend' settings entry
+        """
+        if settings.get('type', 'hci') == 'simulated':
+            return SimulatedBackend(
+                sensors=settings.get('sensors', 5),
+                connect_latency=tuple(settings.get('connect_latency', (0.3, 1.5))),
+                read_latency=tuple(settings.get('read_latency', (0.2, 0.5))),
+                failure_rate=settings.get('failure_rate', 0.05),
+                disconnect_rate=settings.get('disconnect_rate', 0.02),
+                advert_interval=settings.get('advert_interval', 2.0),
+                seed=settings.get('seed', 0)
+            )
+        if settings.get('type') == 'replay':
+            return ReplayBackend(
+                files=settings.get('files', ['sensor_*_history.json']),
+                speed=settings.get('speed', 60.0),
+                fanout=settings.get('fanout', 1),
+                read_latency=settings.get('read_latency', 0.0)
+            )
+        return HciBackend()
+
+class HciBackend(BleBackend):
+    """
+    HciBackend class - Reads real sensors through the HCI adapters.
+
+    The Bluetooth libraries block, which would stall asyncio, so the async
+    methods run get_sensor_data.py and find_new_xdevices.py as subprocesses.
+    Those scripts use the blocking scan() and read_sensor() methods.
+    """
+
+    @staticmethod
+    def interface_index(interface):
+        """
+        Gets the adapter index from an interface name such as hci0
+        """
+        return int(interface[3:]) if interface.startswith('hci') else 0
+
+    @staticmethod
+    def scan(interface, duration):
+        """
+        Blocking scan for devices, returning a dictionary of address -> name
+        """
+        from bluetooth.ble import DiscoveryService
+        service = DiscoveryService(interface)
+        return service.discover(duration)
+
+    @staticmethod
+    def read_sensor(addr, interface=None, since=None):
+        """
+        Blocking read of a single sensor. Returns a dictionary holding the
+        reading, the connect and read times and, if since is given, the
+        on-device history readings after that time.
+        """
+        from lywsd02 import Lywsd02Client
+        client = Lywsd02Client(addr)
+        # Lywsd02Client has no adapter option and connects behind the scenes,
+        # so wrap the peripheral's connect call to choose the adapter and time
+        # the connection
+        connect = client._peripheral.connect
+        connect_seconds = [0.0]
+        def timed_connect(*args, **kwargs):
+            if interface is not None:
+                kwargs['iface'] = HciBackend.interface_index(interface)
+            start = monotonic()
+            connect(*args, **kwargs)
+            connect_seconds[0] += monotonic() - start
+        client._peripheral.connect = timed_connect
+
+        start = monotonic()
+        history = []
+        # Hold one connection open for the reading and any history
+        with client.connect():
+            reading = {
+                'timestamp': datetime.now().isoformat(),
+                'temperature': client.temperature,
+                'humidity': client.humidity,
+                'battery': client.battery
+            }
+            if since is not None:
+                # The sensor sends every record it holds, so the ones
+                # already in the history file are dropped here
+                for record in client.history_data.values():
+                    if record[0] > since:
+                        history.append(history_reading(*record))
+        return {
+            'reading': reading,
+            'connect_seconds': connect_seconds[0],
+            'read_seconds': monotonic() - start - connect_seconds[0],
+            'history': sorted(history, key=lambda r: r['timestamp'])
+        }
+
+    async def discover(self, interface, existing, duration):
+        """
+        Scans for new Xiaomi devices via find_new_xdevices.py
+        """
+        args = [
+            './find_new_xdevices.py',
+            '-d', str(duration),
+            '-i', str(HciBackend.interface_index(interface))
+        ]
+        if len(existing):
+            args += ['-e'] + list(existing)
+        with metrics.timer('worker_spawn_seconds', { 'script': 'find_new_xdevices' }):
+            proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdout=asyncio.subprocess.PIPE
+            )
+        try:
+            data = await asyncio.wait_for(
+                proc.communicate(),
+                timeout=BackendConstants.DISCOVER_TIMEOUT_S
+            )
+        except asyncio.TimeoutError:
+            print(f"Finding devices on {interface} timed out")
+            proc.kill()
+            return {}
+        if proc.returncode == 0:
+            return loads(data[0])
+        return {}
+
+    async def read(self, interface, addr, since=None):
+        """
+        Reads a single sensor via get_sensor_data.py
+        """
+        args = [
+            './get_sensor_data.py',
+            addr,
+            str(HciBackend.interface_index(interface))
+        ]
+        if since is not None:
+            args.append(since.isoformat())
+        with metrics.timer('worker_spawn_seconds', { 'script': 'get_sensor_data' }):
+            proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdout=asyncio.subprocess.PIPE
+            )
+        try:
+            data = await asyncio.wait_for(
+                proc.communicate(),
+                timeout=BackendConstants.READ_TIMEOUT_S
+            )
+        except asyncio.TimeoutError:
+            proc.kill()
+            return ReadResult(ExitCodes.TIMED_OUT)
+        if proc.returncode == ExitCodes.OK:
+            result = loads(data[0])
+            return ReadResult(
+                ExitCodes.OK,
+                result['reading'],
+                result['connect_seconds'],
+                result['read_seconds'],
+                result['history']
+            )
+        return ReadResult(proc.returncode)
+
+class VirtualSensor:
+    """
+    A single simulated sensor
+    """
+
+    def __init__(self, addr, random):
+        """
+        Constructs the sensor with a random starting climate
+        """
+        self.addr = addr
+        self.name = BackendConstants.TEMP_HUM_DEV_NAME
+        self.temperature = random.uniform(17.0, 24.0)
+        self.humidity = random.uniform(35.0, 65.0)
+        self.battery = random.randint(40, 100)
+        # Offset of the first advertisement within the advertising interval
+        self.advert_phase = random.random()
+        # Latency multiplier per interface, drawn when first needed
+        self.reach = {}
+
+    def drift(self, random):
+        """
+        Moves the climate on slightly, as happens between real readings
+        """
+        self.temperature += random.uniform(-0.2, 0.2)
+        self.humidity = min(max(self.humidity + random.uniform(-1, 1), 0), 100)
+
+    def history(self, since, random):
+        """
+        Makes up the hourly on-device records after the given time
+        """
+        now = datetime.now()
+        oldest = now - timedelta(hours=BackendConstants.DEVICE_HISTORY_HOURS)
+        hour = max(since, oldest).replace(minute=0, second=0, microsecond=0)
+        records = []
+        while hour <= now:
+            if hour > since:
+                temp = self.temperature + random.uniform(-1.5, 1.5)
+                hum = int(self.humidity + random.uniform(-5, 5))
+                records.append(history_reading(
+                    hour,
+                    round(temp - random.uniform(0, 1), 1),
+                    hum - random.randint(0, 3),
+                    round(temp + random.uniform(0, 1), 1),
+                    hum + random.randint(0, 3)
+                ))
+            hour += timedelta(hours=1)
+        return records
+
+    def reading(self):
+        """
+        Gets the current reading in the format of a real sensor
+        """
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'temperature': round(self.temperature, 1),
+            'humidity': int(self.humidity),
+            'battery': self.battery
+        }
+
+class SimulatedBackend(BleBackend):
+    """
+    SimulatedBackend class - A fleet of virtual sensors with configurable
+    latency, failure rates, disconnects and advertisement intervals.
+
+    Every interface sees the same fleet, but each draws its own latency
+    multiplier per sensor, so sensors are nearer to some adapters than others.
+    """
+
+    def __init__(self, sensors=5, connect_latency=(0.3, 1.5),
+        read_latency=(0.2, 0.5), failure_rate=0.05, disconnect_rate=0.02,
+        advert_interval=2.0, seed=0):
+        """
+        Constructs the backend. Latencies are (min, max) ranges in seconds,
+        failure_rate is the chance a read times out and disconnect_rate the
+        chance the connection is lost.
+        """
+        self._random = Random(seed)
+        self._connect_latency = connect_latency
+        self._read_latency = read_latency
+        self._failure_rate = failure_rate
+        self._disconnect_rate = disconnect_rate
+        self._advert_interval = advert_interval
+        self._start = monotonic()
+        self.sensors = {}
+        for i in range(sensors):
+            addr = "A4:C1:38:%02X:%02X:%02X" % (i >> 16, (i >> 8) & 0xFF, i & 0xFF)
+            self.sensors[addr] = VirtualSensor(addr, self._random)
+
+    def reach(self, interface, sensor):
+        """
+        Gets the latency multiplier between an interface and a sensor
+        """
+        if interface not in sensor.reach:
+            sensor.reach[interface] = self._random.uniform(1.0, 2.0)
+        return sensor.reach[interface]
+
+    def advertised(self, sensor, start, end):
+        """
+        Whether the sensor advertised between the start and end times
+        """
+        interval = self._advert_interval
+        if interval <= 0 or end - start >= interval:
+            return True
+        first = (start - self._start - sensor.advert_phase * interval) % interval
+        return first == 0 or interval - first <= end - start
+
+    async def discover(self, interface, existing, duration):
+        """
+        Reports the sensors which advertised during the scan
+        """
+        start = monotonic()
+        await asyncio.sleep(duration)
+        found = {}
+        for addr, sensor in self.sensors.items():
+            if self.advertised(sensor, start, monotonic()):
+                found[addr] = sensor.name
+        return new_devices(found, existing)
+
+    async def read(self, interface, addr, since=None):
+        """
+        Simulates connecting to and reading a virtual sensor
+        """
+        sensor = self.sensors.get(addr)
+        if sensor is None:
+            return ReadResult(ExitCodes.DISCONNECTED)
+        reach = self.reach(interface, sensor)
+
+        connect_seconds = self._random.uniform(*self._connect_latency) * reach
+        await asyncio.sleep(connect_seconds)
+        if self._random.random() < self._disconnect_rate:
+            return ReadResult(ExitCodes.DISCONNECTED, connect_seconds=connect_seconds)
+
+        read_seconds = self._random.uniform(*self._read_latency) * reach
+        await asyncio.sleep(read_seconds)
+        if self._random.random() < self._failure_rate:
+            return ReadResult(ExitCodes.TIMED_OUT, None, connect_seconds, read_seconds)
+
+        history = []
+        if since is not None:
+            history = sensor.history(since, self._random)
+            # Each record takes a notification to arrive
+            await asyncio.sleep(len(history) * self._read_latency[0] / 10)
+        sensor.drift(self._random)
+        return ReadResult(
+            ExitCodes.OK,
+            sensor.reading(),
+            connect_seconds,
+            read_seconds,
+            history
+        )
+
+def load_history_readings(filename):
+    """
+    Loads the readings from a history file, oldest first. Both the JSON
+    written by the server and the CSV written by history_to_csv.py are read.
+    A JSON file which was cut short gives the readings before the damage.
+    """
+    readings = []
+    with open(filename, 'r') as f:
+        text = f.read()
+    if filename.endswith('.csv'):
+        for line in text.splitlines():
+            fields = [f.strip() for f in line.split(',')]
+            try:
+                timestamp = BackendConstants.EXCEL_EPOCH + timedelta(days=float(fields[0]))
+            except (ValueError, IndexError):
+                # The header, or a blank line
+                continue
+            values = [None if v in ('', 'None') else float(v) for v in fields[1:4]]
+            readings.append({
+                'timestamp': timestamp.replace(microsecond=0).isoformat(),
+                'temperature': values[0],
+                'humidity': None if values[1] is None else int(values[1]),
+                'battery': None if values[2] is None else int(values[2])
+            })
+    elif len(text):
+        try:
+            data = loads(text)
+            pairs = data.items() if isinstance(data, dict) else [(None, r) for r in data]
+        except ValueError:
+            pairs, _ = recover_records(text)
+            print(f"{filename} is damaged, using the {len(pairs)} readings before the damage")
+        readings = [
+            r for r in (valid_record(k, r) for k, r in pairs) if r is not None
+        ]
+    return sorted(readings, key=lambda r: r['timestamp'])
+
+class Recording:
+    """
+    The readings from one history file, with their offsets in seconds from
+    the first
+    """
+
+    def __init__(self, filename):
+        """
+        Loads the recording from the given file
+        """
+        self.filename = filename
+        self.readings = load_history_readings(filename)
+        if not len(self.readings):
+            self.offsets = []
+            self.length = 0.0
+            return
+        times = [datetime.fromisoformat(r['timestamp']) for r in self.readings]
+        self.offsets = [(t - times[0]).total_seconds() for t in times]
+        # Leave one average gap between the last reading and the first
+        # when the recording loops
+        gap = self.offsets[-1] / (len(self.offsets) - 1) if len(self.offsets) > 1 else 60.0
+        self.length = self.offsets[-1] + gap
+
+class ReplaySensor:
+    """
+    A replayed sensor, playing a recording from its own starting point
+    """
+
+    def __init__(self, addr, recording, phase):
+        """
+        Constructs the sensor, starting phase seconds into the recording
+        """
+        self.addr = addr
+        self.name = BackendConstants.TEMP_HUM_DEV_NAME
+        self.recording = recording
+        self.phase = phase
+        # Position in the endlessly looped recording, in recorded seconds
+        self.position = phase
+        self.last_reading = None
+
+    def readings(self, position, start, speed):
+        """
+        Gets the readings recorded since the last call, up to the given
+        position, with their timestamps moved onto the replay's clock. No
+        more than one loop of the recording is returned.
+        """
+        recording = self.recording
+        begin = max(self.position, position - recording.length)
+        readings = []
+        loop = int(begin // recording.length)
+        while loop * recording.length <= position:
+            base = loop * recording.length
+            first = bisect_right(recording.offsets, begin - base)
+            last = bisect_right(recording.offsets, position - base)
+            for i in range(first, last):
+                played = (base + recording.offsets[i] - self.phase) / speed
+                readings.append({
+                    **recording.readings[i],
+                    'timestamp': (start + timedelta(seconds=played)).isoformat()
+                })
+            loop += 1
+        self.position = position
+        if len(readings):
+            self.last_reading = readings[-1]
+        return readings
+
+class ReplayBackend(BleBackend):
+    """
+    ReplayBackend class - Plays recorded history files through the server
+    at a multiple of real time, for load testing clients.
+
+    Each file is played by fanout sensors, each starting at a different point
+    in the recording, and recordings loop when they reach the end. A read
+    returns everything recorded since the sensor was last read, the newest
+    as the reading and the rest as earlier readings, so the rate of readings
+    follows the speed rather than the read interval. Timestamps are squeezed onto
+    the real clock, so a reading recorded an hour into the file is stamped
+    an hour / speed after the replay started.
+    """
+
+    def __init__(self, files, speed=60.0, fanout=1, read_latency=0.0):
+        """
+        Constructs the backend from a list of file names or glob patterns
+        """
+        self._speed = speed
+        self._read_latency = read_latency
+        own_prefix = 'sensor_' + BackendConstants.REPLAY_ADDR_START.replace(':', '')
+        filenames = sorted({
+            f for pattern in files for f in glob(pattern)
+            if not path.basename(f).startswith(own_prefix)
+        })
+        recordings = []
+        for filename in filenames:
+            try:
+                recording = Recording(filename)
+            except Exception as e:
+                print(f"Skipping {filename}, which could not be read: {e!r}")
+                continue
+            if len(recording.readings):
+                recordings.append(recording)
+        if not len(recordings):
+            raise Exception(f"No history to replay in {files}")
+        self._start = datetime.now()
+        self._start_time = monotonic()
+        self.sensors = {}
+        for i in range(len(recordings) * fanout):
+            recording = recordings[i % len(recordings)]
+            copy = i // len(recordings)
+            addr = "%s:%02X:%02X:%02X" % (
+                BackendConstants.REPLAY_ADDR_START,
+                i >> 16,
+                (i >> 8) & 0xFF,
+                i & 0xFF
+            )
+            self.sensors[addr] = ReplaySensor(
+                addr,
+                recording,
+                recording.length * copy / fanout
+            )
+        print(f"Replaying {len(recordings)} recordings as {len(self.sensors)} "
+            f"sensors at {speed}x")
+
+    async def discover(self, interface, existing, duration):
+        """
+        Reports every replayed sensor straight away
+        """
+        return new_devices(
+            { addr: sensor.name for addr, sensor in self.sensors.items() },
+            existing
+        )
+
+    async def read(self, interface, addr, since=None):
+        """
+        Gets the readings recorded since the sensor was last read
+        """
+        sensor = self.sensors.get(addr)
+        if sensor is None:
+            return ReadResult(ExitCodes.DISCONNECTED)
+        if self._read_latency:
+            await asyncio.sleep(self._read_latency)
+        position = sensor.phase + (monotonic() - self._start_time) * self._speed
+        readings = sensor.readings(position, self._start, self._speed)
+        if not len(readings):
+            # Nothing new was recorded, so the sensor still shows the last
+            if sensor.last_reading is None:
+                return ReadResult(ExitCodes.TIMED_OUT)
+            readings = [sensor.last_reading]
+        return ReadResult(
+            ExitCodes.OK,
+            readings[-1],
+            None,
+            self._read_latency,
+            earlier=readings[:-1]
+        )
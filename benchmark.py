@@ -0,0 +1,343 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package benchmark.py
+
+Measures how the server scales with the size of the sensor fleet and the
+number of connected clients, using the simulated backend and local websocket
+clients. Results are saved as JSON so runs from different commits can be
+compared with --compare.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from json import loads, dumps
+from os import chdir, getcwd, path, devnull
+from statistics import mean, median
+from subprocess import run, PIPE
+from tempfile import TemporaryDirectory
+from time import monotonic
+from backends import SimulatedBackend, new_devices
+from encoding import Encodings
+from wss import SensorServer
+import asyncio
+import platform
+import resource
+import tracemalloc
+import websockets
+
+DEFAULT_SENSORS = [10, 100, 1000]
+DEFAULT_CLIENTS = [1, 10, 100, 500]
+
+def summarise(samples):
+    """
+    Summarises a list of timings in seconds
+    """
+    if not len(samples):
+        return None
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'mean': mean(ordered),
+        'p50': median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'max': ordered[-1]
+    }
+
+def git_commit():
+    """
+    Gets the commit being benchmarked, if known
+    """
+    result = run(
+        ['git', 'rev-parse', 'HEAD'],
+        stdout=PIPE,
+        stderr=PIPE,
+        cwd=path.dirname(path.abspath(__file__))
+    )
+    return result.stdout.decode().strip() if result.returncode == 0 else None
+
+class TimedBackend(SimulatedBackend):
+    """
+    Simulated backend which records the latency of every read
+    """
+
+    def __init__(self, *args, **kwargs):
+        SimulatedBackend.__init__(self, *args, **kwargs)
+        self.latencies = []
+
+    async def read(self, interface, addr, since=None):
+        start = monotonic()
+        result = await SimulatedBackend.read(self, interface, addr, since)
+        self.latencies.append(monotonic() - start)
+        return result
+
+class Benchmark:
+    """
+    Benchmark class - Runs the scenarios for one fleet size
+    """
+
+    def __init__(self, args, sensors):
+        """
+        Constructs the benchmark for the given number of sensors
+        """
+        self._args = args
+        self._sensors = sensors
+        self._history_writes = []
+
+    def prepare_settings(self, backend):
+        """
+        Writes settings and a sensor file so the server starts with the
+        whole simulated fleet already known
+        """
+        settings_file = 'bench_settings.json'
+        settings = SensorServer.load_settings(settings_file)
+        settings['adapters'] = [
+            { 'name': f'sim{i}', 'max_connections': self._args.connections }
+            for i in range(self._args.adapters)
+        ]
+        settings['http_port'] = 0
+        # Keep the server's own gathering loop idle, cycles are run here
+        settings['next_scan'] = (datetime.now() + timedelta(days=1)).isoformat()
+        SensorServer.save_settings(settings, settings_file)
+        devices = new_devices(
+            { addr: s.name for addr, s in backend.sensors.items() },
+            {}
+        )
+        SensorServer.save_devices(devices, settings['sensor_file'])
+        return settings_file
+
+    def timed_history_update(self, update):
+        """
+        Wraps update_histories to record the cost of each write
+        """
+        def timed(*args):
+            start = monotonic()
+            update(*args)
+            self._history_writes.append(monotonic() - start)
+        return timed
+
+    async def run_cycles(self, server, backend):
+        """
+        Runs the reading cycles, returning their measurements. Each reading
+        goes through the server's statistics, rules and MQTT, as it does
+        when the server gathers them.
+        """
+        durations = []
+        for _ in range(self._args.cycles):
+            start = monotonic()
+            await SensorServer.gather_sensor_readings(
+                server._devices,
+                1,
+                server._scheduler,
+                on_reading=server.process_readings
+            )
+            durations.append(monotonic() - start)
+
+        # Measure memory separately, as tracing slows everything down
+        tracemalloc.start()
+        await SensorServer.gather_sensor_readings(
+            server._devices,
+            1,
+            server._scheduler,
+            on_reading=server.process_readings
+        )
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            'sensors': self._sensors,
+            'cycle_seconds': summarise(durations),
+            'reading_latency': summarise(backend.latencies),
+            'history_write': summarise(self._history_writes),
+            'cycle_peak_memory_bytes': peak
+        }
+
+    async def run_broadcasts(self, server, clients):
+        """
+        Connects the given number of clients and measures the sensor
+        broadcasts reaching them
+        """
+        uri = f'ws://localhost:{self._args.port}'
+        subprotocols = None
+        if self._args.encoding != Encodings.JSON:
+            subprotocols = [self._args.encoding]
+        connections = []
+        for _ in range(clients):
+            connection = await websockets.connect(
+                uri,
+                max_size=None,
+                subprotocols=subprotocols,
+                compression='deflate' if self._args.deflate else None
+            )
+            # Each client is first sent the settings and sensors, and
+            # binary clients the key list before them
+            if subprotocols is not None:
+                await connection.recv()
+            await connection.recv()
+            await connection.recv()
+            connections.append(connection)
+
+        async def receive(connection):
+            message = await connection.recv()
+            return monotonic(), len(message)
+
+        latencies = []
+        fanouts = []
+        size = 0
+        for _ in range(self._args.rounds):
+            receivers = [asyncio.ensure_future(receive(c)) for c in connections]
+            start = monotonic()
+            await server.broadcast_sensors()
+            fanouts.append(monotonic() - start)
+            for received, size in await asyncio.gather(*receivers):
+                latencies.append(received - start)
+
+        for connection in connections:
+            await connection.close()
+        # Let the server remove the clients before the next scenario
+        await asyncio.sleep(0.1)
+
+        return {
+            'sensors': self._sensors,
+            'clients': clients,
+            'encoding': self._args.encoding,
+            'deflate': self._args.deflate,
+            'message_bytes': size,
+            'broadcast_latency': summarise(latencies),
+            'broadcast_fanout_seconds': summarise(fanouts),
+            # Peak resident memory of the whole process so far
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        }
+
+    async def run(self):
+        """
+        Runs all the scenarios for this fleet size
+        """
+        backend = TimedBackend(
+            sensors=self._sensors,
+            connect_latency=(0.001, 0.005),
+            read_latency=(0.001, 0.005),
+            failure_rate=0.0,
+            disconnect_rate=0.0,
+            advert_interval=0
+        )
+        settings_file = self.prepare_settings(backend)
+        server = SensorServer(
+            'localhost',
+            self._args.port,
+            settings_file,
+            asyncio.get_event_loop(),
+            backend
+        )
+        ws_server = await server._server
+
+        update = SensorServer.update_histories
+        SensorServer.update_histories = staticmethod(self.timed_history_update(update))
+        try:
+            cycles = await self.run_cycles(server, backend)
+        finally:
+            SensorServer.update_histories = staticmethod(update)
+
+        broadcasts = []
+        for clients in self._args.clients:
+            broadcasts.append(await self.run_broadcasts(server, clients))
+
+        server._gathering = False
+        ws_server.close()
+        await ws_server.wait_closed()
+        return cycles, broadcasts
+
+def compare(results, baseline):
+    """
+    Prints the change in the mean of each measurement against a baseline
+    """
+    def means(entries, keys):
+        found = {}
+        for entry in entries:
+            scenario = tuple(entry.get(k) for k in ('sensors', 'clients'))
+            if 'clients' in entry:
+                # Broadcasts are only comparable with the same encoding,
+                # and results from before encodings were JSON
+                scenario += (
+                    entry.get('encoding', Encodings.JSON),
+                    entry.get('deflate', False)
+                )
+            for key in keys:
+                if entry.get(key):
+                    found[(scenario, key)] = entry[key]['mean']
+        return found
+
+    for section, keys in (
+        ('cycles', ('cycle_seconds', 'reading_latency', 'history_write')),
+        ('broadcasts', ('broadcast_latency', 'broadcast_fanout_seconds'))
+    ):
+        new = means(results[section], keys)
+        old = means(baseline[section], keys)
+        for (scenario, key), value in sorted(new.items()):
+            if (scenario, key) in old and old[(scenario, key)] > 0:
+                change = (value / old[(scenario, key)] - 1) * 100
+                print(f"{section} {scenario} {key}: {old[(scenario, key)]:.6f}s -> {value:.6f}s ({change:+.1f}%)")
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--sensors', type=int, nargs='+',
+        default=DEFAULT_SENSORS, help='Provides the fleet sizes to test.')
+    parser.add_argument('-c', '--clients', type=int, nargs='+',
+        default=DEFAULT_CLIENTS, help='Provides the client counts to test.')
+    parser.add_argument('--cycles', type=int, default=3,
+        help='Provides the reading cycles to time per fleet size.')
+    parser.add_argument('--rounds', type=int, default=5,
+        help='Provides the broadcasts to time per scenario.')
+    parser.add_argument('--adapters', type=int, default=4,
+        help='Provides the number of simulated adapters.')
+    parser.add_argument('--connections', type=int, default=8,
+        help='Provides the connections per simulated adapter.')
+    parser.add_argument('-e', '--encoding', type=str, default=Encodings.JSON,
+        choices=[Encodings.JSON, Encodings.MSGPACK, Encodings.CBOR],
+        help='Provides the message encoding the clients ask for.')
+    parser.add_argument('--deflate', action='store_true',
+        help='Has the clients ask for permessage-deflate compression.')
+    parser.add_argument('-p', '--port', type=int, default=9142,
+        help='Provides the port for the benchmark server.')
+    parser.add_argument('-o', '--output', type=str, default='benchmark.json',
+        help='Provides the file name to save the results to.')
+    parser.add_argument('--compare', type=str, default=None,
+        help='Provides earlier results to compare against.')
+    args = parser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cycles': [],
+        'broadcasts': []
+    }
+    output = path.abspath(args.output)
+    cwd = getcwd()
+    for sensors in args.sensors:
+        print(f"Benchmarking {sensors} sensors...")
+        # History and sensor files are written to a scratch directory, and
+        # the server's own output is hidden
+        with TemporaryDirectory() as scratch, open(devnull, 'w') as quiet:
+            chdir(scratch)
+            try:
+                with redirect_stdout(quiet):
+                    cycles, broadcasts = asyncio.run(Benchmark(args, sensors).run())
+            finally:
+                chdir(cwd)
+        print(f"  cycle {cycles['cycle_seconds']['mean']:.3f}s, " +
+            ", ".join(f"{b['clients']} clients {b['broadcast_latency']['mean']:.4f}s"
+                for b in broadcasts))
+        results['cycles'].append(cycles)
+        results['broadcasts'] += broadcasts
+
+    with open(output, 'w') as f:
+        f.write(dumps(results, sort_keys=True, indent=4))
+    print(f"Results saved to {output}")
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(results, loads(f.read()))
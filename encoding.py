@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package encoding.py
+
+Message encodings for the websocket clients.
+
+Clients pick an encoding by asking for it as a websocket subprotocol when they
+connect: 'msgpack' or 'cbor' for binary messages, or nothing for the original
+JSON text messages. The binary encodings replace well known dictionary keys
+with their index in KEYS. The first message sent to a binary client is
+{'cmd': 'keys', 'data': KEYS}, without key replacement, so it can map them
+back.
+
+MessagePack and CBOR need the msgpack and cbor2 packages, and are only
+offered when they are installed. permessage-deflate compression is
+negotiated separately by the websockets package.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from json import loads, dumps
+from metrics import metrics
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+class Encodings:
+    """
+    Class to provide the encoding names, which are also the subprotocols
+    """
+    JSON                    = 'json'
+    MSGPACK                 = 'msgpack'
+    CBOR                    = 'cbor'
+
+# Keys replaced by their index in the binary encodings. Only ever append to
+# this list, so clients holding an older copy still decode what they know.
+KEYS = [
+    'cmd', 'data', 'addr', 'dev_name', 'sensor_name', 'history_file',
+    'active', 'last_reading', 'timestamp', 'temperature', 'humidity',
+    'battery', 'stats', 'ewma', 'min', 'max', 'mean', 'count',
+    'rate_per_hour', 'gateway', 'rule', 'state', 'value', 'labels', 'sum',
+    'buckets', 'source', 'temperature_min', 'temperature_max',
+    'humidity_min', 'humidity_max', 'version', 'changes', 'reason',
+    'device'
+]
+KEY_INDEX = { key: i for i, key in enumerate(KEYS) }
+
+def available():
+    """
+    Gets the encodings which can be used, in order of preference
+    """
+    encodings = []
+    if msgpack is not None:
+        encodings.append(Encodings.MSGPACK)
+    if cbor2 is not None:
+        encodings.append(Encodings.CBOR)
+    return encodings + [Encodings.JSON]
+
+def compact(value):
+    """
+    Replaces the well known keys in all dictionaries with their index
+    """
+    if isinstance(value, dict):
+        return { KEY_INDEX.get(k, k): compact(v) for k, v in value.items() }
+    if isinstance(value, list):
+        return [compact(v) for v in value]
+    return value
+
+def expand(value):
+    """
+    Restores the keys replaced by compact()
+    """
+    if isinstance(value, dict):
+        return {
+            KEYS[k] if isinstance(k, int) and k < len(KEYS) else k: expand(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [expand(v) for v in value]
+    return value
+
+def encode(message, encoding, replace_keys=True):
+    """
+    Encodes a message dictionary, returning text for JSON and bytes for the
+    binary encodings
+    """
+    with metrics.timer('encode_seconds', { 'encoding': encoding }):
+        if encoding == Encodings.JSON:
+            payload = dumps(message)
+        else:
+            if replace_keys:
+                message = compact(message)
+            if encoding == Encodings.MSGPACK:
+                payload = msgpack.packb(message)
+            elif encoding == Encodings.CBOR:
+                payload = cbor2.dumps(message)
+            else:
+                raise Exception(f"Unknown encoding: {encoding}")
+    return counted(payload, encoding)
+
+def counted(payload, encoding):
+    """
+    Records an encoded message in the metrics, for messages encoded ahead
+    of time as well as by encode()
+    """
+    metrics.inc('encoded_bytes_total', { 'encoding': encoding }, len(payload))
+    metrics.inc('encoded_messages_total', { 'encoding': encoding })
+    return payload
+
+def decode(payload, encoding):
+    """
+    Decodes a message received from a client. Text is always JSON, so a
+    binary client may still send JSON text.
+    """
+    if isinstance(payload, str):
+        return loads(payload)
+    if encoding == Encodings.MSGPACK:
+        return expand(msgpack.unpackb(payload, strict_map_key=False))
+    if encoding == Encodings.CBOR:
+        return expand(cbor2.loads(payload))
+    return loads(payload)
@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package federation.py
+
+Follows other gateway servers over the websocket protocol and merges their
+sensors into a single device map, choosing the best gateway for each sensor.
+
+Clients' patches are checked by the gateway serving the sensor, and once it
+accepts them passed on to every other gateway holding the sensor, so the
+details do not change when a different gateway takes over.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from json import loads, dumps
+from threading import Lock
+import asyncio
+import websockets
+
+class FederationConstants:
+    """
+    Class to provide constant values for federation
+    """
+    RECONNECT_SECONDS       = 5
+
+class Upstream:
+    """
+    Upstream class - The last known state of a single gateway server
+    """
+
+    def __init__(self, uri):
+        """
+        Constructs the upstream for the given websocket URI
+        """
+        self.uri = uri
+        self.connected = False
+        self.devices = {}
+        self.connection = None
+
+    def reading_time(self, addr):
+        """
+        Gets the timestamp of the last reading this gateway has for the
+        given address, or None
+        """
+        device = self.devices.get(addr)
+        if device is None or not device.get('last_reading'):
+            return None
+        return device['last_reading']['timestamp']
+
+class Federation:
+    """
+    Federation class - Subscribes to several gateways and merges their
+    device maps, deduplicating readings by address and timestamp
+    """
+
+    def __init__(self, uris, on_update, on_rejected=None):
+        """
+        Constructs the federation. on_update is a coroutine function called
+        with the merged device map whenever it changes, and on_rejected an
+        optional one called with the client ID and the rejection when a
+        gateway rejects a forwarded patch.
+        """
+        self._upstreams = [Upstream(uri) for uri in uris]
+        self._on_update = on_update
+        self._on_rejected = on_rejected
+        self._lock = Lock()
+        self._running = True
+        # Address -> (timestamp, gateway URI) of the reading being served
+        self._served = {}
+        self._merged = {}
+        # (gateway URI, address) -> [(client ID, patch)] awaiting an answer,
+        # oldest first
+        self._pending = {}
+
+    def tasks(self):
+        """
+        Gets the coroutines which follow each upstream gateway
+        """
+        return [self.follow(upstream) for upstream in self._upstreams]
+
+    def stop(self):
+        """
+        Stops following the upstream gateways
+        """
+        self._running = False
+
+    async def follow(self, upstream):
+        """
+        Keeps a connection open to an upstream gateway, reconnecting
+        whenever it is lost
+        """
+        while self._running:
+            try:
+                async with websockets.connect(upstream.uri) as connection:
+                    print(f"Following gateway {upstream.uri}")
+                    upstream.connected = True
+                    upstream.connection = connection
+                    async for message in connection:
+                        try:
+                            await self.handle_upstream(upstream, loads(message))
+                        except Exception as e:
+                            # One bad message must not stop the gateway
+                            # being followed
+                            print(f"Failed to handle a message from gateway {upstream.uri}: {e!r}")
+            except (OSError, websockets.exceptions.WebSocketException) as e:
+                print(f"Gateway {upstream.uri} unavailable: {e}")
+            except Exception as e:
+                print(f"Lost gateway {upstream.uri}: {e!r}")
+            if upstream.connected:
+                upstream.connected = False
+                upstream.connection = None
+                # Its answers to any forwarded patches are lost
+                for key in [k for k in self._pending if k[0] == upstream.uri]:
+                    del self._pending[key]
+                # Let the other gateways take over this gateway's sensors
+                try:
+                    await self.publish()
+                except Exception as e:
+                    print(f"Failed to publish without gateway {upstream.uri}: {e!r}")
+            await asyncio.sleep(FederationConstants.RECONNECT_SECONDS)
+
+    async def handle_upstream(self, upstream, message):
+        """
+        Handles a message received from an upstream gateway
+        """
+        if message.get('cmd') == 'sensors':
+            devices = message['data']
+            with self._lock:
+                upstream.devices = devices
+            await self.publish()
+        elif message.get('cmd') == 'sensor_patch':
+            # Only the patched fields are sent
+            # Held with a with block, so a malformed patch cannot leave it
+            # locked
+            with self._lock:
+                for patch in message['data']:
+                    if patch['addr'] in upstream.devices:
+                        upstream.devices[patch['addr']] = {
+                            **upstream.devices[patch['addr']],
+                            **patch['changes'],
+                            'version': patch['version']
+                        }
+            for patch in message['data']:
+                if self.take_pending(upstream.uri, patch['addr']) is not None:
+                    await self.share_patch(upstream, patch['addr'], patch['changes'])
+            await self.publish()
+        elif message.get('cmd') == 'patch_rejected':
+            rejection = message['data']
+            pending = self.take_pending(upstream.uri, rejection.get('addr'))
+            if pending is None:
+                print(f"Gateway {upstream.uri} rejected a patch for {rejection.get('addr')}: "
+                    f"{rejection.get('reason')}")
+            elif self._on_rejected is not None:
+                await self._on_rejected(pending[0], rejection)
+
+    def best_gateway(self, addr):
+        """
+        Chooses the connected gateway with the newest reading for the given
+        address. The gateway already serving the sensor wins any tie, so a
+        sensor heard by several gateways does not flip between them.
+        """
+        served = self._served.get(addr)
+        best = None
+        best_time = None
+        for upstream in self._upstreams:
+            if not upstream.connected or addr not in upstream.devices:
+                continue
+            reading_time = upstream.reading_time(addr) or ''
+            if best is None or reading_time > best_time or \
+                (reading_time == best_time and served is not None and
+                    served[1] == upstream.uri):
+                best = upstream
+                best_time = reading_time
+        return best
+
+    def merge(self):
+        """
+        Merges the upstream device maps. Returns the merged map and whether
+        it differs from the one last served. A reading is identified by its
+        address and timestamp, so the same reading relayed again by any
+        gateway does not count as a change.
+        """
+        with self._lock:
+            addrs = set()
+            for upstream in self._upstreams:
+                if upstream.connected:
+                    addrs.update(upstream.devices.keys())
+
+            merged = {}
+            served = {}
+            for addr in sorted(addrs):
+                upstream = self.best_gateway(addr)
+                device = dict(upstream.devices[addr])
+                device['gateway'] = upstream.uri
+                merged[addr] = device
+                served[addr] = (upstream.reading_time(addr), upstream.uri)
+
+        changed = merged != self._merged
+        self._served = served
+        self._merged = merged
+        return merged, changed
+
+    async def publish(self):
+        """
+        Sends the merged device map on, unless nothing has changed since
+        it was last served
+        """
+        merged, changed = self.merge()
+        if changed:
+            await self._on_update(merged)
+
+    def take_pending(self, uri, addr):
+        """
+        Removes and returns the oldest (client ID, patch) forwarded to the
+        given gateway for the given address, or None
+        """
+        pending = self._pending.get((uri, addr))
+        if not pending:
+            return None
+        first = pending.pop(0)
+        if not len(pending):
+            del self._pending[(uri, addr)]
+        return first
+
+    async def forward_patch(self, patch, client_id=None):
+        """
+        Forwards a client's patch for one sensor to the gateway serving it.
+        Returns the rejection if it could not be sent, otherwise None.
+        """
+        addr = patch.get('addr')
+        served = self._served.get(addr)
+        if served is None:
+            print(f"No gateway is serving {addr}")
+            return { 'addr': addr, 'reason': 'unknown_sensor', 'device': None }
+        for upstream in self._upstreams:
+            if upstream.uri == served[1] and upstream.connection is not None:
+                self._pending.setdefault((upstream.uri, addr), []).append(
+                    (client_id, patch)
+                )
+                try:
+                    await upstream.connection.send(dumps({ 'cmd': 'patch', 'data': [patch] }))
+                    return None
+                except websockets.exceptions.WebSocketException as e:
+                    print(f"Could not forward the patch for {addr} to {upstream.uri}: {e}")
+                    pending = self._pending.get((upstream.uri, addr), [])
+                    if (client_id, patch) in pending:
+                        pending.remove((client_id, patch))
+                        if not len(pending):
+                            del self._pending[(upstream.uri, addr)]
+                    break
+        else:
+            print(f"Gateway {served[1]} is not connected")
+        return { 'addr': addr, 'reason': 'unavailable', 'device': self._merged.get(addr) }
+
+    async def share_patch(self, source, addr, changes):
+        """
+        Passes changes accepted by one gateway on to every other connected
+        gateway holding the sensor. They are sent without a version, as
+        each gateway counts its own.
+        """
+        message = dumps({ 'cmd': 'patch', 'data': [{ 'addr': addr, 'changes': changes }] })
+        for upstream in self._upstreams:
+            if upstream is source or upstream.connection is None or \
+                addr not in upstream.devices:
+                continue
+            try:
+                await upstream.connection.send(message)
+            except websockets.exceptions.WebSocketException as e:
+                print(f"Could not pass the patch for {addr} to {upstream.uri}: {e}")
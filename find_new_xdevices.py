@@ -7,8 +7,8 @@ Finds the available Xiaomi sensor devices
 # ------------------------------------------------------------------------------
 #                  Kris Dunning ippie52@gmail.com 2020.
 # ------------------------------------------------------------------------------
-from bluetooth.ble import DiscoveryService
 from argparse import ArgumentParser
+from backends import HciBackend, is_xiaomi_device, new_device
 from json import dumps
 import sys
 
@@ -19,6 +19,8 @@ parser.add_argument('-d', '--duration', type=int, default=DEFAULT_DURATION_S,
     help='Provides the scan duration in whole seconds.')
 parser.add_argument('-e', '--existing', type=str, nargs='+', default=[],
     help='Provides the existing device addresses.')
+parser.add_argument('-i', '--interface', type=int, default=0,
+    help='Provides the HCI adapter index to scan with.')
 
 args = parser.parse_args()
 
@@ -30,31 +32,19 @@ def debug_print(*message):
     NORMAL = '\u001b[0m'
     print(GREEN, *message, NORMAL, file=sys.stderr)
 
-TEMP_HUM_DEV_ADDR_START = "A4:C1:38"
-TEMP_HUM_DEV_NAME       = "LYWSD03MMC"
-
 try:
-    service = DiscoveryService()
     debug_print('Ingnoring:', args.existing)
     debug_print(f"Scanning for {args.duration} seconds...")
-    devices = service.discover(args.duration)
+    devices = HciBackend.scan(f'hci{args.interface}', args.duration)
     debug_print(f"{len(devices)} devices found.")
     x_devices = {}
     next_index = len(args.existing) + 1
 
     for addr, name in devices.items():
-        if addr[:len(TEMP_HUM_DEV_ADDR_START)] == TEMP_HUM_DEV_ADDR_START or \
-            name == TEMP_HUM_DEV_NAME:
+        if is_xiaomi_device(addr, name):
             if addr not in args.existing:
                 debug_print(addr, 'not in', args.existing)
-                device = {
-                    'dev_name': name,
-                    'addr': addr,
-                    'sensor_name': "Sensor %02d" % next_index,
-                    'history_file': f'sensor_{addr.replace(":", "")}_history.json',
-                    'active': True,
-                    'last_reading': None
-                }
+                device = new_device(addr, name, next_index)
                 next_index += 1
                 debug_print(f"New device found: {name}: {addr}")
                 x_devices[addr] = device
@@ -2,7 +2,11 @@
 # ------------------------------------------------------------------------------
 """@package get_sensor_data.py
 
-Gets the sensor data as a JSON formatted dictionary.
+Gets the sensor data as a JSON formatted dictionary, holding the reading and
+the time spent connecting and reading. If a time is given, the on-device
+history records after it are included, fetched over the same connection.
+
+Usage: get_sensor_data.py <address> [HCI adapter index] [ISO format time]
 """
 # ------------------------------------------------------------------------------
 #                  Kris Dunning ippie52@gmail.com 2020.
@@ -10,17 +14,9 @@ Gets the sensor data as a JSON formatted dictionary.
 
 from json import dumps
 from bluepy.btle import BTLEDisconnectError
-from lywsd02 import Lywsd02Client
 from sys import stderr, argv, exit
 from datetime import datetime
-
-class ExitCodes:
-    OK = 0
-    INVALID_ARGS = 1
-    USER_CANCELLED = 2
-    TIMED_OUT = 3
-    DISCONNECTED = 4
-    UNKNOWN_ERROR = 5
+from backends import ExitCodes, HciBackend
 
 def error(*message):
     """
@@ -37,15 +33,11 @@ if __name__ == '__main__':
 
     try:
         error(f"Attempting to connect to {argv[1]}")
-        client = Lywsd02Client(argv[1])
-        reading = {
-            'timestamp': datetime.now().isoformat(),
-            'temperature': client.temperature,
-            'humidity': client.humidity,
-            'battery': client.battery
-        }
-        print(dumps(reading, indent=2))
-        error(dumps(reading, indent=2))
+        interface = f"hci{argv[2]}" if len(argv) > 2 else None
+        since = datetime.fromisoformat(argv[3]) if len(argv) > 3 else None
+        result = HciBackend.read_sensor(argv[1], interface, since)
+        print(dumps(result, indent=2))
+        error(dumps(result['reading'], indent=2))
         exit(ExitCodes.OK)
 
     except KeyboardInterrupt:
@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package http_server.py
+
+A minimal asyncio HTTP/1.1 server for the plain GET endpoints served next to
+the websocket server, with keep-alive connections and cached responses which
+answer If-None-Match requests with 304 Not Modified.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from hashlib import sha1
+import asyncio
+
+class HttpConstants:
+    """
+    Class to provide constant values for the HTTP server
+    """
+    IDLE_TIMEOUT_S          = 30
+    MAX_HEADER_LINES        = 100
+    REASONS = {
+        200: 'OK',
+        304: 'Not Modified',
+        400: 'Bad Request',
+        404: 'Not Found',
+        405: 'Method Not Allowed'
+    }
+
+class HttpResponse:
+    """
+    A response to be sent by the HTTP server
+    """
+
+    def __init__(self, status, body=b'', content_type='text/plain', headers=None):
+        """
+        Constructs the response
+        """
+        self.status = status
+        self.body = body if isinstance(body, bytes) else body.encode()
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    def encode(self, keep_alive):
+        """
+        Encodes the response, ready to be written to the connection
+        """
+        reason = HttpConstants.REASONS.get(self.status, '')
+        lines = [
+            f"HTTP/1.1 {self.status} {reason}",
+            f"Content-Type: {self.content_type}",
+            f"Content-Length: {len(self.body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}"
+        ]
+        lines += [f"{k}: {v}" for k, v in self.headers.items()]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode() + self.body
+
+class CachedResponse:
+    """
+    A body encoded once, with an ETag from its content, which can be served
+    any number of times
+    """
+
+    def __init__(self, body, content_type='application/json'):
+        """
+        Constructs the cached response
+        """
+        self.body = body if isinstance(body, bytes) else body.encode()
+        self.content_type = content_type
+        self.etag = '"' + sha1(self.body).hexdigest() + '"'
+        self._headers = {
+            'ETag': self.etag,
+            'Cache-Control': 'no-cache'
+        }
+
+    def respond(self, headers):
+        """
+        Gets the response to a request with the given headers, which is
+        304 Not Modified if the client already holds this body
+        """
+        if_none_match = headers.get('if-none-match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            if '*' in tags or self.etag in tags or ('W/' + self.etag) in tags:
+                return HttpResponse(304, b'', self.content_type, self._headers)
+        return HttpResponse(200, self.body, self.content_type, self._headers)
+
+class HttpServer:
+    """
+    HttpServer class - Routes GET requests to handlers by path. A handler
+    takes the request path and headers and returns an HttpResponse.
+    """
+
+    def __init__(self):
+        """
+        Constructs the server with no routes
+        """
+        self._routes = {}
+        self._prefixes = []
+        self._server = None
+
+    def route(self, path, handler, prefix=False):
+        """
+        Adds a handler for the given path, or with prefix set, for every
+        path beneath it as well
+        """
+        self._routes[path] = handler
+        if prefix:
+            self._prefixes.append((path.rstrip('/') + '/', handler))
+            self._prefixes.sort(key=lambda p: len(p[0]), reverse=True)
+
+    async def serve(self, addr, port):
+        """
+        Starts serving on the given address and port. Returns whether the
+        port could be used.
+        """
+        try:
+            self._server = await asyncio.start_server(
+                self.handle_connection,
+                addr or None,
+                port
+            )
+        except OSError as e:
+            print(f"HTTP server could not listen on {addr}:{port}: {e}")
+            return False
+        print(f"HTTP server listening on {addr}:{port}")
+        return True
+
+    def close(self):
+        """
+        Stops accepting connections
+        """
+        if self._server is not None:
+            self._server.close()
+
+    def respond(self, path, headers):
+        """
+        Finds the handler for the path, ignoring any query string
+        """
+        target = path.split('?', 1)[0]
+        handler = self._routes.get(target)
+        if handler is None:
+            for prefix, prefix_handler in self._prefixes:
+                if target.startswith(prefix):
+                    handler = prefix_handler
+                    break
+        if handler is None:
+            return HttpResponse(404, 'Not found\n')
+        return handler(target, headers)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves requests on one connection until either end closes it
+        """
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request_line = await asyncio.wait_for(
+                        reader.readline(),
+                        timeout=HttpConstants.IDLE_TIMEOUT_S
+                    )
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+
+                headers = {}
+                for _ in range(HttpConstants.MAX_HEADER_LINES):
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    response = HttpResponse(400, 'Bad request\n')
+                    keep_alive = False
+                else:
+                    method, path, version = parts
+                    connection = headers.get('connection', '').lower()
+                    keep_alive = connection != 'close' and \
+                        (version == 'HTTP/1.1' or connection == 'keep-alive')
+                    if method != 'GET':
+                        response = HttpResponse(405, 'Only GET is supported\n')
+                    else:
+                        response = self.respond(path, headers)
+                writer.write(response.encode(keep_alive))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
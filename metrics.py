@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package metrics.py
+
+Counters and histograms describing where the server spends its time, which
+can be rendered in the Prometheus text format or as a dictionary for the
+websocket 'stats' command.
+
+The module level metrics instance is shared by everything in the server.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+import asyncio
+
+class MetricsConstants:
+    """
+    Class to provide constant values for metrics
+    """
+    # Bucket upper bounds in seconds, from event loop lag to BLE timeouts
+    BUCKETS = (
+        0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0,
+        2.5, 5.0, 10.0, 30.0, 60.0, 180.0
+    )
+    ATTEMPT_BUCKETS = (1, 2, 3, 4, 5, 10)
+    LAG_INTERVAL_S = 0.5
+
+def label_key(labels):
+    """
+    Converts a label dictionary into a hashable, ordered key
+    """
+    return tuple(sorted(labels.items())) if labels else ()
+
+def format_labels(key, extra=None):
+    """
+    Formats a label key in the Prometheus text format
+    """
+    pairs = list(key) + ([extra] if extra else [])
+    if not len(pairs):
+        return ''
+    escaped = [
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs
+    ]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+class Histogram:
+    """
+    A histogram with fixed bucket bounds for one set of labels
+    """
+
+    def __init__(self, buckets):
+        """
+        Constructs the empty histogram
+        """
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Adds a single value
+        """
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        """
+        Gets the cumulative bucket counts, as Prometheus expects
+        """
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+class Metrics:
+    """
+    Metrics class - A registry of named counters and histograms
+    """
+
+    def __init__(self):
+        """
+        Constructs the empty registry
+        """
+        self._lock = Lock()
+        self._help = {}
+        self._types = {}
+        self._buckets = {}
+        self._values = {}
+
+    def describe(self, name, help_text, kind='counter', buckets=None):
+        """
+        Registers a metric, which is a counter or a histogram
+        """
+        self._lock.acquire(True)
+        self._help[name] = help_text
+        self._types[name] = kind
+        self._buckets[name] = buckets or MetricsConstants.BUCKETS
+        self._values.setdefault(name, {})
+        self._lock.release()
+
+    def inc(self, name, labels=None, value=1):
+        """
+        Increases a counter
+        """
+        key = label_key(labels)
+        self._lock.acquire(True)
+        values = self._values[name]
+        values[key] = values.get(key, 0) + value
+        self._lock.release()
+
+    def observe(self, name, value, labels=None):
+        """
+        Adds a value to a histogram
+        """
+        key = label_key(labels)
+        self._lock.acquire(True)
+        values = self._values[name]
+        if key not in values:
+            values[key] = Histogram(self._buckets[name])
+        values[key].observe(value)
+        self._lock.release()
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """
+        Times the enclosed block into a histogram
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start, labels)
+
+    def render(self):
+        """
+        Renders all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        self._lock.acquire(True)
+        for name in sorted(self._values):
+            kind = self._types[name]
+            lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(self._values[name].items()):
+                if kind == 'histogram':
+                    for bound, count in zip(value.buckets, value.cumulative()):
+                        lines.append(f"{name}_bucket{format_labels(key, ('le', bound))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(key, ('le', '+Inf'))} {value.count}")
+                    lines.append(f"{name}_sum{format_labels(key)} {value.sum}")
+                    lines.append(f"{name}_count{format_labels(key)} {value.count}")
+                else:
+                    lines.append(f"{name}{format_labels(key)} {value}")
+        self._lock.release()
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Gets all metrics as a dictionary suitable for sending as JSON
+        """
+        result = {}
+        self._lock.acquire(True)
+        for name in sorted(self._values):
+            entries = []
+            for key, value in sorted(self._values[name].items()):
+                entry = { 'labels': dict(key) }
+                if self._types[name] == 'histogram':
+                    entry['count'] = value.count
+                    entry['sum'] = value.sum
+                    entry['mean'] = value.sum / value.count if value.count else None
+                    entry['buckets'] = dict(zip(
+                        [str(b) for b in value.buckets],
+                        value.cumulative()
+                    ))
+                else:
+                    entry['value'] = value
+                entries.append(entry)
+            result[name] = entries
+        self._lock.release()
+        return result
+
+async def monitor_event_loop_lag(running=lambda: True):
+    """
+    Measures how late the event loop wakes from a short sleep, which is how
+    long other work held it up
+    """
+    interval = MetricsConstants.LAG_INTERVAL_S
+    while running():
+        start = monotonic()
+        await asyncio.sleep(interval)
+        metrics.observe('event_loop_lag_seconds', max(0.0, monotonic() - start - interval))
+
+metrics = Metrics()
+metrics.describe('sensor_connect_seconds',
+    'Time taken to connect to a sensor', 'histogram')
+metrics.describe('sensor_read_seconds',
+    'Time taken to read a sensor once connected', 'histogram')
+metrics.describe('sensor_attempts',
+    'Attempts made per reading', 'histogram', MetricsConstants.ATTEMPT_BUCKETS)
+metrics.describe('sensor_results_total',
+    'Read attempts by sensor and exit code')
+metrics.describe('worker_spawn_seconds',
+    'Time taken to start a helper subprocess', 'histogram')
+metrics.describe('discovery_seconds',
+    'Time taken to scan for new devices', 'histogram')
+metrics.describe('cycle_seconds',
+    'Time taken by a complete reading cycle', 'histogram')
+metrics.describe('history_write_seconds',
+    'Time taken to update a history file', 'histogram')
+metrics.describe('backfill_readings_total',
+    'Readings recovered from on-device history')
+metrics.describe('broadcast_seconds',
+    'Time taken to send a message to every client', 'histogram')
+metrics.describe('encode_seconds',
+    'Time taken to encode a message', 'histogram')
+metrics.describe('encoded_bytes_total',
+    'Bytes of encoded messages, before websocket compression')
+metrics.describe('encoded_messages_total',
+    'Messages encoded')
+metrics.describe('mqtt_published_total',
+    'Readings published to the MQTT broker')
+metrics.describe('mqtt_batches_total',
+    'Batches of readings published to the MQTT broker')
+metrics.describe('mqtt_dropped_total',
+    'Readings dropped from a full MQTT queue')
+metrics.describe('event_loop_lag_seconds',
+    'Delay in the event loop waking from a sleep', 'histogram')
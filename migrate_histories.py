@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package migrate_histories.py
+
+Checks and migrates sensor history files to the current storage format,
+using every CPU core.
+
+Each file is loaded, or where it was cut short (for example by a crash while
+it was being rewritten) every complete record before the damage is recovered.
+Records are checked, deduplicated by timestamp and written back in the format
+the server writes, keeping the original alongside as a .bak file. A second
+pass then reloads every file written and checks it holds what was intended.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from argparse import ArgumentParser
+from datetime import datetime
+from glob import glob
+from json import loads, dumps, JSONDecoder
+from multiprocessing import Pool, cpu_count
+from os import path, replace
+from shutil import copyfile
+from time import monotonic
+import sys
+
+class MigrateConstants:
+    """
+    Class to provide constant values for migration
+    """
+    PATTERN                 = 'sensor_*_history.json'
+    NUMBER_FIELDS           = ('temperature', 'humidity', 'battery')
+    OK                      = 'ok'
+    MIGRATED                = 'migrated'
+    RECOVERED               = 'recovered'
+    FAILED                  = 'failed'
+
+class Pairs(list):
+    """
+    The key, value pairs of a JSON object, kept as a list so repeated keys
+    are not lost
+    """
+
+def as_dicts(value):
+    """
+    Converts the Pairs within a loaded value back into dictionaries
+    """
+    if isinstance(value, Pairs):
+        return { k: as_dicts(v) for k, v in value }
+    if isinstance(value, list):
+        return [as_dicts(v) for v in value]
+    return value
+
+def valid_record(key, record):
+    """
+    Gets the record in the current format, or None if it cannot be used
+    """
+    if not isinstance(record, dict):
+        return None
+    timestamp = record.get('timestamp', key)
+    try:
+        datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+    for field in MigrateConstants.NUMBER_FIELDS:
+        value = record.get(field)
+        if value is not None and \
+            (isinstance(value, bool) or not isinstance(value, (int, float))):
+            return None
+    return { **record, 'timestamp': timestamp }
+
+def recover_records(text):
+    """
+    Reads the complete "timestamp": {record} pairs from the start of a
+    damaged history file. Returns the pairs, in file order, and whether the
+    whole file was read.
+    """
+    decoder = JSONDecoder()
+    pairs = []
+    i = text.find('{')
+    if i < 0:
+        return pairs, False
+    i += 1
+    length = len(text)
+    while True:
+        while i < length and text[i] in ' \t\r\n,':
+            i += 1
+        if i >= length:
+            return pairs, False
+        if text[i] == '}':
+            return pairs, True
+        try:
+            key, i = decoder.raw_decode(text, i)
+            while i < length and text[i] in ' \t\r\n':
+                i += 1
+            if i >= length or text[i] != ':':
+                return pairs, False
+            i += 1
+            while i < length and text[i] in ' \t\r\n':
+                i += 1
+            record, i = decoder.raw_decode(text, i)
+        except ValueError:
+            return pairs, False
+        pairs.append((key, record))
+
+def format_history(history):
+    """
+    Formats a history dictionary the way the server writes it
+    """
+    return dumps(history, sort_keys=True, indent=4)
+
+def migrate_file(job):
+    """
+    Migrates a single history file. Runs in a worker process, so takes and
+    returns plain values: (filename, dry_run, backup) and a result
+    dictionary.
+    """
+    filename, dry_run, backup = job
+    result = {
+        'file': filename,
+        'status': MigrateConstants.OK,
+        'records': 0,
+        'duplicates': 0,
+        'invalid': 0,
+        'error': None
+    }
+    try:
+        with open(filename, 'r') as f:
+            text = f.read()
+        complete = True
+        try:
+            data = loads(text, object_pairs_hook=Pairs) if len(text.strip()) else []
+            if isinstance(data, Pairs):
+                pairs = [(k, as_dicts(r)) for k, r in data]
+            else:
+                # Records saved as a list, rather than keyed by timestamp
+                pairs = [(None, as_dicts(r)) for r in data]
+        except ValueError:
+            pairs, complete = recover_records(text)
+            if not len(pairs):
+                raise Exception("no records could be recovered")
+
+        history = {}
+        for key, record in pairs:
+            record = valid_record(key, record)
+            if record is None:
+                result['invalid'] += 1
+            elif record['timestamp'] in history:
+                # The server keeps the first reading for a timestamp
+                result['duplicates'] += 1
+            else:
+                history[record['timestamp']] = record
+        result['records'] = len(history)
+
+        migrated = format_history(history)
+        if not complete:
+            result['status'] = MigrateConstants.RECOVERED
+        elif migrated != text:
+            result['status'] = MigrateConstants.MIGRATED
+        if result['status'] != MigrateConstants.OK and not dry_run:
+            if backup:
+                copyfile(filename, filename + '.bak')
+            temp_filename = filename + '.tmp'
+            with open(temp_filename, 'w') as f:
+                f.write(migrated)
+            replace(temp_filename, filename)
+    except Exception as e:
+        result['status'] = MigrateConstants.FAILED
+        result['error'] = str(e)
+    return result
+
+def verify_file(job):
+    """
+    Checks a migrated file loads, is in the current format and holds the
+    expected number of records. Returns (filename, error or None).
+    """
+    filename, expected = job
+    try:
+        with open(filename, 'r') as f:
+            text = f.read()
+        history = loads(text)
+        if len(history) != expected:
+            return filename, f"holds {len(history)} records, expected {expected}"
+        for key, record in history.items():
+            if valid_record(key, record) is None or record['timestamp'] != key:
+                return filename, f"invalid record {key}"
+        if format_history(history) != text:
+            return filename, "is not in the current format"
+    except Exception as e:
+        return filename, str(e)
+    return filename, None
+
+def run_pool(function, jobs, processes, describe):
+    """
+    Runs the jobs across the worker processes, printing progress as each
+    finishes. Returns the results in the order they finished.
+    """
+    results = []
+    with Pool(processes) as pool:
+        for result in pool.imap_unordered(function, jobs):
+            results.append(result)
+            print(f"[{len(results)}/{len(jobs)}] {describe(result)}")
+    return results
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('files', type=str, nargs='*',
+        default=[MigrateConstants.PATTERN],
+        help='History files, or glob patterns, to migrate. Defaults to '
+            f'{MigrateConstants.PATTERN}.')
+    parser.add_argument('-j', '--jobs', type=int, default=cpu_count(),
+        help='Number of worker processes, by default one per CPU core.')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+        help='Reports what would be changed without writing anything.')
+    parser.add_argument('--no-backup', action='store_true',
+        help='Does not keep the original of each changed file as .bak.')
+    args = parser.parse_args()
+
+    filenames = sorted({
+        f for pattern in args.files for f in glob(pattern)
+        if path.isfile(f)
+    })
+    if not len(filenames):
+        print("No history files found.")
+        sys.exit(0)
+
+    print(f"Migrating {len(filenames)} history files with {args.jobs} workers...")
+    start = monotonic()
+    results = run_pool(
+        migrate_file,
+        [(f, args.dry_run, not args.no_backup) for f in filenames],
+        args.jobs,
+        lambda r: f"{r['file']}: {r['status']}, {r['records']} records, "
+            f"{r['duplicates']} duplicates, {r['invalid']} invalid"
+            + (f" ({r['error']})" if r['error'] else '')
+    )
+
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    print(f"Done in {monotonic() - start:.1f}s: "
+        + ', '.join(f"{n} {status}" for status, n in sorted(counts.items())))
+    print(f"{sum(r['records'] for r in results)} records kept, "
+        f"{sum(r['duplicates'] for r in results)} duplicates and "
+        f"{sum(r['invalid'] for r in results)} invalid records dropped")
+
+    failures = [r for r in results if r['status'] == MigrateConstants.FAILED]
+    if args.dry_run:
+        sys.exit(1 if len(failures) else 0)
+
+    print("Verifying...")
+    checks = run_pool(
+        verify_file,
+        [
+            (r['file'], r['records']) for r in results
+            if r['status'] != MigrateConstants.FAILED
+        ],
+        args.jobs,
+        lambda c: f"{c[0]}: {c[1] or 'ok'}"
+    )
+    errors = [c for c in checks if c[1] is not None]
+    print(f"Verified {len(checks) - len(errors)} of {len(checks)} files")
+    sys.exit(1 if len(failures) or len(errors) else 0)
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package mqtt.py
+
+Publishes every new reading to an MQTT broker, for systems which consume
+MQTT rather than the websocket messages.
+
+Each sensor has its own topic, <topic>/<address without colons>, and the
+readings are retained so a new subscriber gets the last value straight away.
+Readings are queued and sent in batches. While the broker is unreachable they
+wait in a bounded queue, and the oldest are dropped once it is full.
+
+Needs the paho-mqtt package, and is only enabled when it is installed.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from collections import deque
+from json import dumps
+from metrics import metrics
+import asyncio
+
+try:
+    import paho.mqtt.client as paho
+except ImportError:
+    paho = None
+
+class MqttConstants:
+    """
+    Class to provide constant values for the MQTT publisher
+    """
+    PORT                    = 1883
+    TOPIC                   = 'xiaomi'
+    QOS                     = 1
+    BATCH_SECONDS           = 1.0
+    BATCH_SIZE              = 100
+    QUEUE_SIZE              = 10000
+    KEEPALIVE_SECONDS       = 60
+
+def available():
+    """
+    Whether MQTT publishing can be used
+    """
+    return paho is not None
+
+class MqttPublisher:
+    """
+    MqttPublisher class - Queues readings and publishes them to a broker
+    """
+
+    def __init__(self, host, port=MqttConstants.PORT, topic=MqttConstants.TOPIC,
+        qos=MqttConstants.QOS, retain=True, batch_seconds=MqttConstants.BATCH_SECONDS,
+        batch_size=MqttConstants.BATCH_SIZE, queue_size=MqttConstants.QUEUE_SIZE,
+        client_id='', username=None, password=None):
+        """
+        Constructs the publisher. Up to batch_size readings are sent at once,
+        at most batch_seconds after the first was queued. queue_size bounds
+        the readings kept while the broker is unreachable.
+        """
+        self._host = host
+        self._port = port
+        self._topic = topic.rstrip('/')
+        self._qos = qos
+        self._retain = retain
+        self._batch_seconds = batch_seconds
+        self._batch_size = batch_size
+        self._queue = deque()
+        self._queue_size = queue_size
+        self._ready = asyncio.Event()
+        self._loop = None
+        self._running = True
+        self.connected = False
+
+        if hasattr(paho, 'CallbackAPIVersion'):
+            self._client = paho.Client(paho.CallbackAPIVersion.VERSION2, client_id=client_id)
+        else:
+            self._client = paho.Client(client_id=client_id)
+        if username is not None:
+            self._client.username_pw_set(username, password)
+        # paho keeps QoS 1 and 2 messages until they are acknowledged, so
+        # bound those too
+        self._client.max_queued_messages_set(queue_size)
+        self._client.on_connect = self.on_connect
+        self._client.on_disconnect = self.on_disconnect
+
+    @staticmethod
+    def from_settings(settings):
+        """
+        Creates the publisher described by the 'mqtt' settings entry, or
+        None if there is none or paho-mqtt is not installed
+        """
+        if not settings:
+            return None
+        if not available():
+            print("MQTT publishing needs the paho-mqtt package")
+            return None
+        return MqttPublisher(**settings)
+
+    def on_connect(self, client, userdata, flags, reason_code, *args):
+        """
+        Called by paho, from its own thread, once the broker has answered
+        the connection
+        """
+        self.connected = reason_code == 0
+        if self.connected:
+            print(f"Connected to MQTT broker {self._host}:{self._port}")
+            # Events are not thread safe, so wake the publisher from its loop
+            self._loop.call_soon_threadsafe(self._ready.set)
+        else:
+            print(f"MQTT broker {self._host}:{self._port} refused the connection: {reason_code}")
+
+    def on_disconnect(self, client, userdata, *args):
+        """
+        Called by paho when the connection is lost. It reconnects itself.
+        """
+        if self.connected:
+            print(f"Lost the MQTT broker {self._host}:{self._port}")
+        self.connected = False
+
+    def topic(self, addr):
+        """
+        Gets the topic for the given sensor
+        """
+        return f"{self._topic}/{addr.replace(':', '')}"
+
+    def publish_readings(self, device, readings):
+        """
+        Queues new readings for a device, oldest first
+        """
+        topic = self.topic(device.addr)
+        for reading in readings:
+            if len(self._queue) >= self._queue_size:
+                self._queue.popleft()
+                metrics.inc('mqtt_dropped_total')
+            self._queue.append((topic, dumps({
+                'addr': device.addr,
+                'sensor_name': device.sensor_name,
+                **reading
+            })))
+        if len(self._queue):
+            self._ready.set()
+
+    async def run(self):
+        """
+        Connects to the broker and publishes the queued readings in batches
+        until stopped
+        """
+        self._loop = asyncio.get_running_loop()
+        self._client.connect_async(
+            self._host,
+            self._port,
+            MqttConstants.KEEPALIVE_SECONDS
+        )
+        self._client.loop_start()
+        try:
+            while self._running:
+                await self._ready.wait()
+                self._ready.clear()
+                # Give the rest of the batch a chance to arrive
+                if len(self._queue) < self._batch_size:
+                    await asyncio.sleep(self._batch_seconds)
+                if self.connected:
+                    self.flush()
+                if len(self._queue) and self.connected:
+                    # paho's own queue is full, so give it a batch delay to
+                    # drain before trying the rest
+                    await asyncio.sleep(self._batch_seconds)
+                    self._ready.set()
+        finally:
+            self._client.loop_stop()
+            self._client.disconnect()
+
+    def flush(self):
+        """
+        Publishes the queued readings, a batch at a time, stopping if the
+        connection is lost so the rest wait for the broker
+        """
+        sent = 0
+        while len(self._queue) and self.connected:
+            topic, payload = self._queue[0]
+            info = self._client.publish(topic, payload, self._qos, self._retain)
+            if info.rc != paho.MQTT_ERR_SUCCESS:
+                break
+            self._queue.popleft()
+            sent += 1
+            if sent % self._batch_size == 0:
+                metrics.inc('mqtt_batches_total')
+        if sent % self._batch_size:
+            metrics.inc('mqtt_batches_total')
+        metrics.inc('mqtt_published_total', None, sent)
+
+    def stop(self):
+        """
+        Stops publishing
+        """
+        self._running = False
+        self._ready.set()
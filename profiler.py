@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package profiler.py
+
+A sampling CPU profiler with tracemalloc snapshots, for finding where a
+running server spends its cycles without restarting it.
+
+A background thread samples the server thread's stack at a fixed interval, so
+the cost stays small and only code actually running is counted; coroutines
+waiting on BLE or sockets are not on the stack. Each sample is attributed to
+the first of the hot paths found on the stack.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from collections import Counter
+from threading import Thread, Event, get_ident
+from time import monotonic
+import sys
+import tracemalloc
+
+class ProfilerConstants:
+    """
+    Class to provide constant values for profiling
+    """
+    INTERVAL_S              = 0.005
+    TOP                     = 10
+    HOT_PATHS = (
+        'gather_readings',
+        'update_histories',
+        'broadcast_sensors',
+        'handle_message',
+        'read_sensor'
+    )
+    # Functions which mean the event loop is waiting for something to do
+    IDLE_FUNCTIONS          = ('select', 'poll', 'epoll', '_run_once')
+
+def describe(code):
+    """
+    Describes a code object as function (file:line)
+    """
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """
+    SamplingProfiler class - Samples one thread's stack until stopped
+    """
+
+    def __init__(self, thread_id=None, interval=ProfilerConstants.INTERVAL_S,
+        hot_paths=ProfilerConstants.HOT_PATHS):
+        """
+        Constructs the profiler for the given thread, by default the one
+        constructing it
+        """
+        self._thread_id = thread_id or get_ident()
+        self._interval = interval
+        self._hot_paths = hot_paths
+        self._stop = Event()
+        self._thread = None
+        self._samples = 0
+        self._idle = 0
+        self._leaves = Counter()
+        self._paths = { p: Counter() for p in hot_paths }
+        self._started_tracing = False
+        self._first_snapshot = None
+        self._last_snapshot = None
+        self._peak_memory = 0
+        self._start = None
+        self._duration = 0.0
+
+    def running(self):
+        """
+        Whether the profiler is sampling
+        """
+        return self._thread is not None
+
+    def start(self):
+        """
+        Starts sampling and tracing allocations
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        tracemalloc.reset_peak()
+        self._first_snapshot = tracemalloc.take_snapshot()
+        self._start = monotonic()
+        self._thread = Thread(target=self.sample_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling and takes the final allocation snapshot
+        """
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._duration = monotonic() - self._start
+        self._last_snapshot = tracemalloc.take_snapshot()
+        _, self._peak_memory = tracemalloc.get_traced_memory()
+        if self._started_tracing:
+            tracemalloc.stop()
+
+    def sample_loop(self):
+        """
+        Takes samples until stopped
+        """
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self.sample(frame)
+
+    def sample(self, frame):
+        """
+        Counts a single stack sample
+        """
+        self._samples += 1
+        leaf = frame.f_code
+        if leaf.co_name in ProfilerConstants.IDLE_FUNCTIONS:
+            self._idle += 1
+            return
+        self._leaves[describe(leaf)] += 1
+        while frame is not None:
+            if frame.f_code.co_name in self._paths:
+                self._paths[frame.f_code.co_name][describe(leaf)] += 1
+                break
+            frame = frame.f_back
+
+    def report(self, top=ProfilerConstants.TOP):
+        """
+        Gets the results as a dictionary suitable for sending as JSON
+        """
+        samples = max(self._samples, 1)
+        hot_paths = {}
+        for path, counts in self._paths.items():
+            total = sum(counts.values())
+            hot_paths[path] = {
+                'samples': total,
+                'fraction': total / samples,
+                'top_functions': counts.most_common(top)
+            }
+
+        allocations = []
+        if self._first_snapshot is not None and self._last_snapshot is not None:
+            for stat in self._last_snapshot.compare_to(
+                self._first_snapshot,
+                'lineno'
+            )[:top]:
+                frame = stat.traceback[0]
+                allocations.append([
+                    f"{frame.filename}:{frame.lineno}",
+                    stat.size_diff,
+                    stat.count_diff
+                ])
+
+        return {
+            'duration_seconds': self._duration,
+            'interval_seconds': self._interval,
+            'samples': self._samples,
+            'idle_fraction': self._idle / samples,
+            'top_functions': self._leaves.most_common(top),
+            'hot_paths': hot_paths,
+            'memory': {
+                'peak_bytes': self._peak_memory,
+                'top_allocations': allocations
+            }
+        }
+
+def print_report(report):
+    """
+    Prints a profile report in a readable form
+    """
+    print(f"Profiled {report['duration_seconds']:.1f}s, {report['samples']} samples, "
+        f"{report['idle_fraction'] * 100:.1f}% idle")
+    for path, stats in report['hot_paths'].items():
+        print(f"  {path}: {stats['fraction'] * 100:.1f}% of samples")
+        for function, count in stats['top_functions']:
+            print(f"    {count:6d} {function}")
+    print("  Top functions:")
+    for function, count in report['top_functions']:
+        print(f"    {count:6d} {function}")
+    print(f"  Peak traced memory: {report['memory']['peak_bytes']} bytes")
+    for location, size, count in report['memory']['top_allocations']:
+        print(f"    {size:+10d} bytes {count:+6d} blocks {location}")
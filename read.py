@@ -1,8 +1,8 @@
 #!/usr/bin/python3
-from bluetooth.ble import DiscoveryService, GATTRequester
+from bluetooth.ble import GATTRequester
 from time import sleep
 from struct import unpack
-from lywsd02 import Lywsd02Client
+from backends import HciBackend, new_devices
 from datetime import datetime, timedelta
 from json import dumps, loads
 from os import path
@@ -160,26 +160,11 @@ def find_new_xiaomi_devices(existing, duration):
     Assigns a new name to the device in the form:
     Sensor xx, where xx is the next available index
     """
-    next_index = len(existing) + 1
-    x_devices = {}
-    service = DiscoveryService()
-    devices = service.discover(duration)
+    devices = HciBackend.scan('hci0', duration)
     print(f"Scanning found {len(devices)} devices.")
-    for addr, name in devices.items():
-        if addr[:len(TEMP_HUM_DEV_ADDR_START)] == TEMP_HUM_DEV_ADDR_START or \
-            name == TEMP_HUM_DEV_NAME:
-            if addr not in existing:
-                device = {
-                    'dev_name': name,
-                    'addr': addr,
-                    'sensor_name': "Sensor %02d" % next_index,
-                    'history_file': f'sensor_{addr.replace(":", "")}_history.json',
-                    'active': True,
-                    'last_reading': None
-                }
-                next_index += 1
-                print(f"Found new device: {name}: {addr}")
-                x_devices[addr] = device
+    x_devices = new_devices(devices, existing)
+    for addr, device in x_devices.items():
+        print(f"Found new device: {device['dev_name']}: {addr}")
     if len(x_devices):
         print(f"Only {len(x_devices)} were new")
     else:
@@ -248,14 +233,8 @@ def gather_readings(devices, max_attempts):
             try:
                 attempts += 1
                 print(f"Attempting to read from sensor {device['sensor_name']}...")
-                client = Lywsd02Client(device['addr'])
-                reading = {
-                    'timestamp': datetime.now().isoformat(),
-                    'temperature': client.temperature,
-                    'humidity': client.humidity,
-                    'battery': client.battery
-                }
-                devices[addr]['last reading'] = reading
+                reading = HciBackend.read_sensor(device['addr'])['reading']
+                devices[addr]['last_reading'] = reading
                 update_histories(devices[addr], reading)
                 print(f"Device {device['sensor_name']} ({device['addr']}) -> {dumps(reading, sort_keys=True, indent=4)}")
                 readings_complete = True
@@ -0,0 +1,453 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package registry.py
+
+The server's record of every known device, indexed by address and by name.
+
+Each device is a DeviceRecord with fixed slots, and the numeric values of the
+last readings are kept together in one array owned by the registry. The
+dictionary and JSON forms sent to clients and saved to file are cached per
+device, so only the devices which changed are rebuilt.
+
+Every device has a version, increased whenever one of its editable fields is
+patched, so a client can ask for a change only if nobody else has made one
+since it last saw the device.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from array import array
+from json import dumps
+from math import isnan
+
+class RegistryConstants:
+    """
+    Class to provide constant values for the device registry
+    """
+    # Reading values kept in the numeric array, with the type they are
+    # given back as
+    READING_FIELDS          = (
+        ('temperature', float),
+        ('humidity', int),
+        ('battery', int)
+    )
+    DEVICE_FIELDS           = (
+        'dev_name', 'addr', 'sensor_name', 'history_file', 'active',
+        'last_reading', 'stats', 'gateway', 'version'
+    )
+    # Fields clients may patch, with their types
+    EDITABLE_FIELDS         = { 'sensor_name': str, 'active': bool }
+    MISSING                 = float('nan')
+
+def default_history_file(addr):
+    """
+    Gets the history file name used for a device unless it has its own
+    """
+    return f'sensor_{addr.replace(":", "")}_history.json'
+
+def address_key(addr):
+    """
+    Normalises an address for lookups, so it may be given with or without
+    colons and in either case
+    """
+    return addr.replace(':', '').upper()
+
+class DeviceRecord:
+    """
+    A single device. Records are changed through the registry, which keeps
+    its indexes and caches up to date.
+    """
+    __slots__ = (
+        'registry', 'index', 'addr', 'dev_name', 'sensor_name',
+        '_history_file', 'active', 'timestamp', 'reading_extra', 'stats',
+        'gateway', 'version', 'extra', '_dict', '_json', '_indented_json'
+    )
+
+    def __init__(self, registry, index, addr):
+        """
+        Constructs the empty record at the given index in the registry's
+        reading values
+        """
+        self.registry = registry
+        self.index = index
+        self.addr = addr
+        self.dev_name = None
+        self.sensor_name = None
+        self._history_file = None
+        self.active = True
+        self.timestamp = None
+        self.reading_extra = None
+        self.stats = None
+        self.gateway = None
+        self.version = 0
+        self.extra = None
+        self._dict = None
+        self._json = None
+        self._indented_json = None
+
+    @property
+    def history_file(self):
+        """
+        Gets the name of the device's history file
+        """
+        return self._history_file or default_history_file(self.addr)
+
+    @property
+    def last_reading(self):
+        """
+        Gets the last reading as a dictionary, or None if there is none
+        """
+        if self.timestamp is None:
+            return None
+        reading = { 'timestamp': self.timestamp }
+        values = self.registry.values_of(self.index)
+        for (field, kind), value in zip(RegistryConstants.READING_FIELDS, values):
+            if isnan(value):
+                reading[field] = None
+            else:
+                reading[field] = int(value) if kind is int and value.is_integer() else value
+        if self.reading_extra is not None:
+            reading.update(self.reading_extra)
+        return reading
+
+    def load(self, device):
+        """
+        Sets the record from a device dictionary
+        """
+        self.dev_name = device.get('dev_name')
+        self.sensor_name = device.get('sensor_name')
+        history_file = device.get('history_file')
+        if history_file == default_history_file(self.addr):
+            history_file = None
+        self._history_file = history_file
+        self.active = device.get('active', True)
+        self.stats = device.get('stats')
+        self.gateway = device.get('gateway')
+        self.version = device.get('version', 0)
+        extra = {
+            k: v for k, v in device.items()
+            if k not in RegistryConstants.DEVICE_FIELDS
+        }
+        self.extra = extra or None
+        self.set_reading(device.get('last_reading'))
+
+    def set_reading(self, reading):
+        """
+        Stores a reading dictionary, or clears it with None
+        """
+        self.changed()
+        if not reading:
+            self.timestamp = None
+            self.reading_extra = None
+            self.registry.set_values(self.index, None)
+            return
+        self.timestamp = reading['timestamp']
+        self.registry.set_values(self.index, reading)
+        extra = {
+            k: v for k, v in reading.items()
+            if k != 'timestamp' and k not in self.registry.reading_fields
+        }
+        self.reading_extra = extra or None
+
+    def changed(self):
+        """
+        Drops the cached forms of the record, and of the whole registry
+        """
+        self._dict = None
+        self._json = None
+        self._indented_json = None
+        self.registry.changed()
+
+    def as_dict(self):
+        """
+        Gets the record as a device dictionary. The dictionary is cached, so
+        must not be changed.
+        """
+        if self._dict is None:
+            device = {
+                'dev_name': self.dev_name,
+                'addr': self.addr,
+                'sensor_name': self.sensor_name,
+                'history_file': self.history_file,
+                'active': self.active,
+                'version': self.version
+            }
+            reading = self.last_reading
+            if reading is not None:
+                device['last_reading'] = reading
+            if self.stats is not None:
+                device['stats'] = self.stats
+            if self.gateway is not None:
+                device['gateway'] = self.gateway
+            if self.extra is not None:
+                device.update(self.extra)
+            self._dict = device
+        return self._dict
+
+    def as_json(self):
+        """
+        Gets the record as JSON text
+        """
+        if self._json is None:
+            self._json = dumps(self.as_dict(), sort_keys=True)
+        return self._json
+
+    def as_indented_json(self):
+        """
+        Gets the record as JSON text indented by four spaces, the way the
+        device file is written
+        """
+        if self._indented_json is None:
+            self._indented_json = dumps(self.as_dict(), sort_keys=True, indent=4)
+        return self._indented_json
+
+class DeviceRegistry:
+    """
+    DeviceRegistry class - All known devices, looked up by address like the
+    dictionary it replaces
+    """
+
+    def __init__(self, devices=None):
+        """
+        Constructs the registry from a dictionary of device dictionaries
+        keyed by address
+        """
+        self.reading_fields = tuple(f for f, _ in RegistryConstants.READING_FIELDS)
+        self._width = len(self.reading_fields)
+        self._values = array('d')
+        self._free = []
+        self._by_addr = {}
+        self._by_key = {}
+        self._by_name = {}
+        self._dict = None
+        self._json = None
+        self._indented_json = None
+        for device in (devices or {}).values():
+            self.add(device)
+
+    def __len__(self):
+        return len(self._by_addr)
+
+    def __contains__(self, addr):
+        return addr in self._by_addr
+
+    def __iter__(self):
+        return iter(self._by_addr)
+
+    def __getitem__(self, addr):
+        return self._by_addr[addr]
+
+    def keys(self):
+        """
+        Gets the device addresses
+        """
+        return self._by_addr.keys()
+
+    def values(self):
+        """
+        Gets the device records
+        """
+        return self._by_addr.values()
+
+    def items(self):
+        """
+        Gets the (address, record) pairs
+        """
+        return self._by_addr.items()
+
+    def get(self, addr, default=None):
+        """
+        Gets the record for an address, or the default
+        """
+        return self._by_addr.get(addr, default)
+
+    def by_name(self, name):
+        """
+        Gets the record for a sensor name, or None
+        """
+        return self._by_name.get(name)
+
+    def find(self, key):
+        """
+        Gets the record for an address, given with or without colons, or
+        for a sensor name, or None
+        """
+        return self._by_key.get(address_key(key)) or self._by_name.get(key)
+
+    def values_of(self, index):
+        """
+        Gets the reading values stored at a record's index
+        """
+        start = index * self._width
+        return self._values[start:start + self._width]
+
+    def set_values(self, index, reading):
+        """
+        Stores the reading values at a record's index
+        """
+        start = index * self._width
+        for i, field in enumerate(self.reading_fields):
+            value = reading.get(field) if reading else None
+            self._values[start + i] = RegistryConstants.MISSING if value is None else value
+
+    def changed(self):
+        """
+        Drops the cached forms of the whole registry
+        """
+        self._dict = None
+        self._json = None
+        self._indented_json = None
+
+    def add(self, device):
+        """
+        Adds a device dictionary, or updates the record already held for
+        its address. Returns whether anything changed.
+        """
+        addr = device['addr']
+        record = self._by_addr.get(addr)
+        if record is not None:
+            if record.as_dict() == device:
+                return False
+            self.unindex_name(record)
+        else:
+            if len(self._free):
+                index = self._free.pop()
+            else:
+                index = len(self._values) // self._width
+                self._values.extend([RegistryConstants.MISSING] * self._width)
+            record = DeviceRecord(self, index, addr)
+            self._by_addr[addr] = record
+            self._by_key[address_key(addr)] = record
+        record.load(device)
+        self.index_name(record)
+        return True
+
+    def remove(self, addr):
+        """
+        Removes the device with the given address
+        """
+        record = self._by_addr.pop(addr)
+        del self._by_key[address_key(addr)]
+        self.unindex_name(record)
+        self.set_values(record.index, None)
+        self._free.append(record.index)
+        self.changed()
+
+    def replace(self, devices):
+        """
+        Makes the registry hold exactly the given device dictionaries,
+        only rebuilding the records which differ. Returns the addresses
+        which changed.
+        """
+        changed = [addr for addr in self._by_addr if addr not in devices]
+        for addr in changed:
+            self.remove(addr)
+        for addr, device in devices.items():
+            if self.add({ **device, 'addr': addr }):
+                changed.append(addr)
+        return changed
+
+    def update(self, addr, fields):
+        """
+        Changes some fields of a device. Returns whether anything changed.
+        """
+        record = self._by_addr[addr]
+        device = { **record.as_dict(), **fields }
+        return self.add(device)
+
+    def check_patch(self, addr, changes, version=None):
+        """
+        Checks whether a patch can be applied. Returns None if it can,
+        otherwise the reason it cannot: 'unknown_sensor', 'invalid' or
+        'conflict' if the device is no longer at the given version.
+        """
+        record = self._by_addr.get(addr)
+        if record is None:
+            return 'unknown_sensor'
+        if not isinstance(changes, dict) or not len(changes):
+            return 'invalid'
+        for field, value in changes.items():
+            kind = RegistryConstants.EDITABLE_FIELDS.get(field)
+            if kind is None or not isinstance(value, kind):
+                return 'invalid'
+        if version is not None and version != record.version:
+            return 'conflict'
+        return None
+
+    def patch(self, addr, changes):
+        """
+        Applies a checked patch, moving the device on a version if it
+        changed anything. Returns the new version.
+        """
+        record = self._by_addr[addr]
+        if any(getattr(record, f) != v for f, v in changes.items()):
+            self.update(addr, { **changes, 'version': record.version + 1 })
+        return record.version
+
+    def set_reading(self, addr, reading):
+        """
+        Stores a new last reading for a device
+        """
+        self._by_addr[addr].set_reading(reading)
+
+    def set_stats(self, addr, stats):
+        """
+        Stores new rolling statistics for a device
+        """
+        record = self._by_addr[addr]
+        record.stats = stats
+        record.changed()
+
+    def index_name(self, record):
+        """
+        Adds a record to the name index
+        """
+        if record.sensor_name is not None:
+            self._by_name[record.sensor_name] = record
+
+    def unindex_name(self, record):
+        """
+        Removes a record from the name index
+        """
+        if self._by_name.get(record.sensor_name) is record:
+            del self._by_name[record.sensor_name]
+
+    def as_dict(self):
+        """
+        Gets every device as a dictionary keyed by address. The result is
+        cached, so must not be changed.
+        """
+        if self._dict is None:
+            self._dict = {
+                addr: record.as_dict() for addr, record in self._by_addr.items()
+            }
+        return self._dict
+
+    def as_json(self):
+        """
+        Gets every device as JSON text, reusing the text of the devices
+        which have not changed
+        """
+        if self._json is None:
+            self._json = '{' + ', '.join(
+                f'{dumps(addr)}: {record.as_json()}'
+                for addr, record in sorted(self._by_addr.items())
+            ) + '}'
+        return self._json
+
+    def as_indented_json(self):
+        """
+        Gets every device as JSON text indented by four spaces, the same
+        as dumps(self.as_dict(), sort_keys=True, indent=4), reusing the
+        text of the devices which have not changed
+        """
+        if self._indented_json is None:
+            if not len(self._by_addr):
+                self._indented_json = '{}'
+            else:
+                self._indented_json = '{\n' + ',\n'.join(
+                    f'    {dumps(addr)}: ' +
+                        record.as_indented_json().replace('\n', '\n    ')
+                    for addr, record in sorted(self._by_addr.items())
+                ) + '\n}'
+        return self._indented_json
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package rolling.py
+
+Rolling statistics for each sensor, updated as every reading arrives so they
+can be sent with the live sensor information.
+
+Each window keeps its readings in a queue with a running sum, and min/max in
+monotonic queues, so adding a reading costs O(1) amortised however long the
+window is.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from collections import deque
+from datetime import datetime
+
+class RollingConstants:
+    """
+    Class to provide constant values for rolling statistics
+    """
+    FIELDS                  = ('temperature', 'humidity')
+    # Window name -> length in minutes
+    WINDOWS                 = { '1h': 60, '24h': 1440 }
+    EWMA_ALPHA              = 0.2
+
+class RollingWindow:
+    """
+    Min, max, mean and rate of change of one value over a time window
+    """
+
+    def __init__(self, seconds):
+        """
+        Constructs the empty window
+        """
+        self.seconds = seconds
+        self.values = deque()
+        self.mins = deque()
+        self.maxs = deque()
+        self.total = 0.0
+
+    def add(self, time, value):
+        """
+        Adds a value, where time is in seconds since the epoch, and drops
+        any values which have fallen out of the window
+        """
+        self.values.append((time, value))
+        self.total += value
+        while len(self.mins) and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((time, value))
+        while len(self.maxs) and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append((time, value))
+
+        oldest = time - self.seconds
+        while self.values[0][0] < oldest:
+            self.total -= self.values.popleft()[1]
+        while self.mins[0][0] < oldest:
+            self.mins.popleft()
+        while self.maxs[0][0] < oldest:
+            self.maxs.popleft()
+
+    def summary(self):
+        """
+        Gets the statistics for the values in the window
+        """
+        first_time, first = self.values[0]
+        last_time, last = self.values[-1]
+        hours = (last_time - first_time) / 3600
+        return {
+            'min': self.mins[0][1],
+            'max': self.maxs[0][1],
+            'mean': round(self.total / len(self.values), 2),
+            'count': len(self.values),
+            'rate_per_hour': round((last - first) / hours, 2) if hours > 0 else None
+        }
+
+class FieldStatistics:
+    """
+    The EWMA and windows for one value of one sensor
+    """
+
+    def __init__(self, windows, alpha):
+        """
+        Constructs the empty statistics
+        """
+        self.alpha = alpha
+        self.ewma = None
+        self.windows = {
+            name: RollingWindow(minutes * 60) for name, minutes in windows.items()
+        }
+
+    def add(self, time, value):
+        """
+        Adds a value to the average and every window
+        """
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            self.ewma = self.alpha * value + (1 - self.alpha) * self.ewma
+        for window in self.windows.values():
+            window.add(time, value)
+
+    def summary(self):
+        """
+        Gets the statistics for this value
+        """
+        summary = { 'ewma': round(self.ewma, 2) }
+        for name, window in self.windows.items():
+            summary[name] = window.summary()
+        return summary
+
+class RollingStatistics:
+    """
+    RollingStatistics class - Keeps the rolling statistics for every sensor
+    """
+
+    def __init__(self, windows=None, alpha=RollingConstants.EWMA_ALPHA):
+        """
+        Constructs the statistics, where windows maps window names to
+        lengths in minutes
+        """
+        self._windows = windows or RollingConstants.WINDOWS
+        self._alpha = alpha
+        self._devices = {}
+        self._last_time = {}
+
+    def add(self, addr, reading):
+        """
+        Adds a reading for the given sensor. Readings older than the last
+        one added are ignored. Returns the sensor's updated statistics.
+        """
+        time = datetime.fromisoformat(reading['timestamp']).timestamp()
+        if addr not in self._devices:
+            self._devices[addr] = {
+                field: FieldStatistics(self._windows, self._alpha)
+                for field in RollingConstants.FIELDS
+            }
+        if time > self._last_time.get(addr, 0):
+            self._last_time[addr] = time
+            for field, stats in self._devices[addr].items():
+                if reading.get(field) is not None:
+                    stats.add(time, reading[field])
+        return self.summary(addr)
+
+    def summary(self, addr):
+        """
+        Gets the statistics for the given sensor, or None if it has none
+        """
+        if addr not in self._devices:
+            return None
+        return {
+            field: stats.summary()
+            for field, stats in self._devices[addr].items()
+            if stats.ewma is not None
+        }
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+# ------------------------------------------------------------------------------
+"""@package rules.py
+
+Evaluates alert rules against the live readings as they arrive.
+
+Rules are given as dictionaries in the settings, either a threshold which
+must hold for a while:
+
+    { 'name': 'Damp', 'field': 'humidity', 'op': '>', 'value': 70,
+      'for_minutes': 10 }
+
+or a deadline for the next reading:
+
+    { 'name': 'Quiet', 'type': 'stale', 'minutes': 15 }
+
+Either may be limited to some sensors with 'sensors': [addresses].
+
+Each rule keeps a little state per sensor, so a reading only costs the rules
+that apply to its sensor. Stale deadlines are kept in a heap, so checking
+them only looks at the ones which have passed.
+"""
+# ------------------------------------------------------------------------------
+#                  Kris Dunning ippie52@gmail.com 2020.
+# ------------------------------------------------------------------------------
+from datetime import datetime, timedelta
+from heapq import heappush, heappop
+import operator
+
+class RuleConstants:
+    """
+    Class to provide constant values for the rules engine
+    """
+    OPERATORS = {
+        '>': operator.gt,
+        '>=': operator.ge,
+        '<': operator.lt,
+        '<=': operator.le,
+        '==': operator.eq,
+        '!=': operator.ne
+    }
+    FIRING                  = 'firing'
+    RESOLVED                = 'resolved'
+
+def is_number(value):
+    """
+    Whether a settings value is a number, which a bool is not
+    """
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class Rule:
+    """
+    A single rule, as described in the settings
+    """
+
+    def __init__(self, settings):
+        """
+        Constructs the rule from its settings entry, raising an exception if
+        it is not valid
+        """
+        self.name = settings['name']
+        self.type = settings.get('type', 'threshold')
+        if 'sensors' in settings and not isinstance(settings['sensors'], list):
+            raise Exception(f"Sensors in rule {self.name} must be a list")
+        self.sensors = set(settings['sensors']) if 'sensors' in settings else None
+        if self.type == 'stale':
+            if not is_number(settings['minutes']):
+                raise Exception(f"Minutes in rule {self.name} must be a number")
+            self.duration = timedelta(minutes=settings['minutes'])
+        elif self.type == 'threshold':
+            if settings['op'] not in RuleConstants.OPERATORS:
+                raise Exception(f"Unknown operator in rule {self.name}: {settings['op']}")
+            if not isinstance(settings['field'], str):
+                raise Exception(f"Field in rule {self.name} must be a string")
+            if not is_number(settings['value']):
+                raise Exception(f"Value in rule {self.name} must be a number")
+            if not is_number(settings.get('for_minutes', 0)):
+                raise Exception(f"For minutes in rule {self.name} must be a number")
+            self.field = settings['field']
+            self.op = settings['op']
+            self.compare = RuleConstants.OPERATORS[settings['op']]
+            self.value = settings['value']
+            self.duration = timedelta(minutes=settings.get('for_minutes', 0))
+        else:
+            raise Exception(f"Unknown rule type: {self.type}")
+
+    def applies_to(self, addr):
+        """
+        Whether the rule covers the given sensor
+        """
+        return self.sensors is None or addr in self.sensors
+
+class RulesEngine:
+    """
+    RulesEngine class - Turns readings into alert events
+    """
+
+    def __init__(self, rule_settings):
+        """
+        Constructs the engine from the 'rules' settings list
+        """
+        self._rules = [Rule(r) for r in rule_settings]
+        self._threshold_rules = {}
+        self._stale_rules = {}
+        # (rule name, address) -> time the condition started to hold
+        self._since = {}
+        # (rule name, address) -> the alert currently firing
+        self._active = {}
+        # Heap of (deadline, rule name, address), and the current deadline
+        # for each, so superseded heap entries can be skipped
+        self._deadlines = []
+        self._deadline = {}
+        self._last_time = {}
+
+    def rules_for(self, addr):
+        """
+        Gets the threshold and stale rules covering the given sensor
+        """
+        if addr not in self._threshold_rules:
+            rules = [r for r in self._rules if r.applies_to(addr)]
+            self._threshold_rules[addr] = [r for r in rules if r.type == 'threshold']
+            self._stale_rules[addr] = [r for r in rules if r.type == 'stale']
+        return self._threshold_rules[addr], self._stale_rules[addr]
+
+    def active_alerts(self):
+        """
+        Gets the alerts which are currently firing
+        """
+        return list(self._active.values())
+
+    def alert(self, rule, device, state, time, value=None):
+        """
+        Creates an alert event, keeping track of the active alerts
+        """
+        alert = {
+            'rule': rule.name,
+            'addr': device.addr,
+            'sensor_name': device.sensor_name,
+            'state': state,
+            'timestamp': time.isoformat(),
+            'value': value
+        }
+        if state == RuleConstants.FIRING:
+            self._active[(rule.name, device.addr)] = alert
+        else:
+            self._active.pop((rule.name, device.addr), None)
+        return alert
+
+    def add(self, device, reading):
+        """
+        Evaluates a new reading for the given device. Readings no newer than
+        the last one seen are ignored. Returns any alert events raised.
+        """
+        addr = device.addr
+        time = datetime.fromisoformat(reading['timestamp'])
+        if addr in self._last_time and time <= self._last_time[addr]:
+            return []
+        self._last_time[addr] = time
+        threshold_rules, stale_rules = self.rules_for(addr)
+        alerts = []
+
+        for rule in threshold_rules:
+            key = (rule.name, addr)
+            value = reading.get(rule.field)
+            try:
+                holds = value is not None and rule.compare(value, rule.value)
+            except Exception as e:
+                # A bad reading must not stop the other rules or readings
+                print(f"Rule {rule.name} failed for {addr}: {e!r}")
+                continue
+            if holds:
+                since = self._since.setdefault(key, time)
+                if key not in self._active and time - since >= rule.duration:
+                    alerts.append(self.alert(rule, device, RuleConstants.FIRING, time, value))
+            else:
+                self._since.pop(key, None)
+                if key in self._active:
+                    alerts.append(self.alert(rule, device, RuleConstants.RESOLVED, time, value))
+
+        for rule in stale_rules:
+            key = (rule.name, addr)
+            if key in self._active:
+                alerts.append(self.alert(rule, device, RuleConstants.RESOLVED, time))
+            deadline = time + rule.duration
+            self._deadline[key] = deadline
+            heappush(self._deadlines, (deadline, rule.name, addr))
+        return alerts
+
+    def watch(self, device):
+        """
+        Starts the stale deadlines for a device which has not been read yet
+        """
+        addr = device.addr
+        _, stale_rules = self.rules_for(addr)
+        for rule in stale_rules:
+            key = (rule.name, addr)
+            if key not in self._deadline:
+                deadline = datetime.now() + rule.duration
+                self._deadline[key] = deadline
+                heappush(self._deadlines, (deadline, rule.name, addr))
+
+    def check_stale(self, devices, now=None):
+        """
+        Raises alerts for sensors whose deadlines have passed
+        """
+        now = now or datetime.now()
+        rules = { r.name: r for r in self._rules }
+        alerts = []
+        while len(self._deadlines) and self._deadlines[0][0] <= now:
+            deadline, name, addr = heappop(self._deadlines)
+            key = (name, addr)
+            if self._deadline.get(key) != deadline or key in self._active:
+                continue
+            if addr in devices:
+                alerts.append(self.alert(
+                    rules[name],
+                    devices[addr],
+                    RuleConstants.FIRING,
+                    now
+                ))
+        return alerts
@@ -9,16 +9,28 @@ and humidity sensors.
 #                  Kris Dunning ippie52@gmail.com 2020.
 # ------------------------------------------------------------------------------
 from threading import Lock
-from bluetooth.ble import DiscoveryService, GATTRequester
 from datetime import datetime, timedelta
-from os import path
+from os import path, replace
+from urllib.parse import unquote
 from json import loads, dumps
-from bluepy.btle import BTLEDisconnectError
-from time import sleep
-from lywsd02 import Lywsd02Client
-from get_sensor_data import ExitCodes
+from time import sleep, monotonic, time
+from backends import ExitCodes, BleBackend
+from adapters import AdapterScheduler
+from federation import Federation
+from metrics import metrics, monitor_event_loop_lag
+from http_server import HttpServer, HttpResponse, CachedResponse
+from profiler import SamplingProfiler, print_report
+from rolling import RollingStatistics
+from rules import RulesEngine
+from encoding import Encodings, KEYS
+from registry import DeviceRegistry, RegistryConstants
+from mqtt import MqttPublisher, MqttConstants
+import encoding
+from argparse import ArgumentParser
 import asyncio
 import websockets
+import pickle
+import signal
 import sys
 
 class Constants:
@@ -30,15 +42,23 @@ class Constants:
     SETTINGS_FILENAME       = "wss_settings.json"
     TEMP_HUM_DEV_ADDR_START = "A4:C1:38"
     TEMP_HUM_DEV_NAME       = "LYWSD03MMC"
+    ALERT_CHECK_SECONDS     = 10
+    SNAPSHOT_VERSION        = 1
 
 class SensorServer:
     """
     SensorServer class - Provides the server methods
     """
+    # History file name -> (last timestamp, file size) as last written, so
+    # new readings can be appended without reading the whole file
+    history_ends = {}
 
-    def __init__(self, addr, port, settings_filename, loop):
+    def __init__(self, addr, port, settings_filename, loop, backend=None,
+        overrides=None):
         """
-        Constructs the server
+        Constructs the server. The backend is created from the settings
+        unless one is given. overrides replaces settings for this run only,
+        and is never written to the settings file.
         """
         self._addr = addr
         self._port = port
@@ -51,17 +71,112 @@ class SensorServer:
         self._client_lock = Lock()
         self._settings_lock = Lock()
         self._clients = {}
+        self._encodings = {}
         self._client_count = 0
+        self._profiler = None
+        self._profile_cycles = 0
+        self._profile_client = None
 
-        # Load saved settings
+        # Load saved settings, keeping the saved values of any overrides
         self._settings = SensorServer.load_settings(self._settings_filename)
+        self._overrides = overrides or {}
+        self._saved_overrides = {
+            key: self._settings.get(key) for key in self._overrides
+        }
+        self._settings = { **self._settings, **self._overrides }
+        SensorServer.check_settings(self._settings)
+
+        # Load the state saved when the server last stopped, so clients get
+        # the last known readings and statistics straight away
+        snapshot = SensorServer.load_snapshot(self._settings['snapshot_file'])
+
+        # Load saved device information, unless the snapshot is newer
+        sensor_file = self._settings['sensor_file']
+        if snapshot is not None and \
+            (not path.isfile(sensor_file) or path.getmtime(sensor_file) <= snapshot['saved']):
+            self._devices = DeviceRegistry(snapshot['devices'])
+            print(f"Restored {len(self._devices)} devices from {self._settings['snapshot_file']}")
+        else:
+            self._devices = DeviceRegistry(SensorServer.load_devices(sensor_file))
 
-        # Load saved device information
-        self._devices = SensorServer.load_devices(self._settings['sensor_file'])
+        # Rolling statistics sent with each device, starting from the
+        # last known readings
+        if snapshot is not None and \
+            snapshot['stats_settings'] == self.stats_settings():
+            self._statistics = snapshot['statistics']
+        else:
+            self._statistics = RollingStatistics(
+                self._settings['stats_windows'],
+                self._settings['stats_alpha']
+            )
+        for addr, device in self._devices.items():
+            if device.last_reading is not None:
+                self._devices.set_stats(
+                    addr,
+                    self._statistics.add(addr, device.last_reading)
+                )
+
+        # Alert rules, evaluated against each reading as it arrives
+        # Always built, so rules in the settings file are checked even when
+        # the snapshot's are used
+        self._rules = RulesEngine(self._settings['rules'])
+        if snapshot is not None and snapshot['rule_settings'] == self._settings['rules']:
+            self._rules = snapshot['rules']
+        for device in self._devices.values():
+            self._rules.watch(device)
+        self._loop.create_task(self.check_alerts())
+        self._snapshot_task = None
+        if self._settings['snapshot_minutes']:
+            self._snapshot_task = self._loop.create_task(self.save_snapshots())
+
+        # Share the devices between the configured Bluetooth adapters
+        self._backend = backend
+        if self._backend is None:
+            self._backend = BleBackend.from_settings(self._settings['backend'])
+        self._scheduler = AdapterScheduler.from_settings(
+            self._settings['adapters'],
+            self._backend
+        )
+
+        # In aggregator mode the sensors come from other gateways instead
+        self._federation = None
+        if len(self._settings['upstreams']):
+            self._federation = Federation(
+                self._settings['upstreams'],
+                self.update_federated_sensors,
+                self.reject_patch
+            )
+            for task in self._federation.tasks():
+                self._loop.create_task(task)
+        else:
+            self._loop.create_task(self.gather_readings())
 
-        self._loop.create_task(self.gather_readings())
+        # Optionally publish every reading to an MQTT broker too
+        self._mqtt = MqttPublisher.from_settings(self._settings['mqtt'])
+        if self._mqtt is not None:
+            self._loop.create_task(self._mqtt.run())
         # self._loop.create_task(self.receive_messages())
-        self._server = websockets.serve(self.new_client, self._addr, self._port)
+        self._server = websockets.serve(
+            self.new_client,
+            self._addr,
+            self._port,
+            subprotocols=encoding.available(),
+            compression='deflate' if self._settings['compression'] else None
+        )
+
+        # Plain HTTP endpoints for the metrics and the latest readings. The
+        # readings are encoded on the first request after they change.
+        self._snapshot_cache = {}
+        self._http = HttpServer()
+        self._http.route('/metrics', self.serve_metrics)
+        self._http.route('/sensors', self.serve_sensors, prefix=True)
+        if self._settings['http_port']:
+            self._loop.create_task(
+                self._http.serve(self._addr, self._settings['http_port'])
+            )
+        self._loop.create_task(
+            monitor_event_loop_lag(lambda: self._receiving)
+        )
 
     async def receive_messages(self):
         """
@@ -98,6 +213,9 @@ class SensorServer:
                 scan_seconds = self._settings['scan_seconds']
                 sensor_file = self._settings['sensor_file']
                 max_attempts = self._settings['max_attempts']
+                backfill = None
+                if self._settings['backfill_minutes']:
+                    backfill = timedelta(minutes=self._settings['backfill_minutes'])
                 interval = timedelta(
                     minutes=self._settings['interval']['mins'],
                     seconds=self._settings['interval']['secs']
@@ -108,12 +226,15 @@ class SensorServer:
                 # Load any newly discovered devices
                 new_x_devices = await SensorServer.find_new_xiaomi_devices(
                     self._devices,
-                    scan_seconds
+                    scan_seconds,
+                    self._scheduler
                 )
                 if len(new_x_devices):
                     self._sensor_lock.acquire(True)
-                    self._devices = { **self._devices, **new_x_devices }
                     print(f"Newly discovered devices: {new_x_devices}")
+                    for addr, device in new_x_devices.items():
+                        self._devices.add(device)
+                        self._rules.watch(self._devices[addr])
                     SensorServer.save_devices(
                         self._devices,
                         sensor_file
@@ -121,10 +242,14 @@ class SensorServer:
                     self._sensor_lock.release()
 
                 print("Finished scanning, go get readings...")
-                devices = await SensorServer.gather_sensor_readings(
-                    self._devices,
-                    max_attempts
-                )
+                with metrics.timer('cycle_seconds'):
+                    devices = await SensorServer.gather_sensor_readings(
+                        self._devices,
+                        max_attempts,
+                        self._scheduler,
+                        backfill,
+                        self.process_readings
+                    )
                 self._sensor_lock.acquire(True)
                 self._devices = devices
                 # Save the updated readings
@@ -145,29 +270,182 @@ class SensorServer:
 
                 self._settings_lock.acquire(True)
                 self._settings['next_scan'] = next_scan.isoformat()
-                settings = self._settings
+                self.save_settings_file()
                 self._settings_lock.release()
-
-                SensorServer.save_settings(
-                    settings,
-                    self._settings_filename
-                )
+                await self.profile_cycle_done()
                 print("Done for now.")
             else:
                 await asyncio.sleep(1)
 
-    async def broadcast_message(self, message_json, client_id=None):
+    async def process_readings(self, addr, readings):
+        """
+        Updates the rolling statistics for a device's new readings, oldest
+        first, sends out any alerts they raise and queues them for MQTT
+        """
+        device = self._devices[addr]
+        if self._mqtt is not None:
+            self._mqtt.publish_readings(device, readings)
+        alerts = []
+        for reading in readings:
+            self._devices.set_stats(addr, self._statistics.add(addr, reading))
+            alerts += self._rules.add(device, reading)
+        self._snapshot_cache = {}
+        await self.broadcast_alerts(alerts)
+
+    def save_settings_file(self):
+        """
+        Saves the settings, as they were before any overrides, to the
+        settings file. The settings lock must be held.
+        """
+        settings = { **self._settings, **self._saved_overrides }
+        SensorServer.save_settings(settings, self._settings_filename)
+        self._settings['save_id'] = settings['save_id']
+
+    def stats_settings(self):
+        """
+        Gets the settings the rolling statistics were created with
+        """
+        return [self._settings['stats_windows'], self._settings['stats_alpha']]
+
+    async def save_snapshots(self):
+        """
+        Runs forever saving the state at the snapshot interval, so little
+        is lost if the server is killed. Only started when the interval
+        is not 0, and restarted when it changes.
+        """
+        while self._receiving:
+            await asyncio.sleep(self._settings['snapshot_minutes'] * 60)
+            self.save_snapshot()
+
+    def save_snapshot(self):
+        """
+        Saves the devices, rolling statistics and alert state to the
+        snapshot file
+        """
+        self._sensor_lock.acquire(True)
+        self._settings_lock.acquire(True)
+        state = {
+            'version': Constants.SNAPSHOT_VERSION,
+            'saved': time(),
+            'devices': self._devices.as_dict(),
+            'stats_settings': self.stats_settings(),
+            'statistics': self._statistics,
+            'rule_settings': self._settings['rules'],
+            'rules': self._rules,
+            'history_ends': dict(SensorServer.history_ends)
+        }
+        filename = self._settings['snapshot_file']
+        try:
+            SensorServer.write_snapshot(state, filename)
+        finally:
+            self._settings_lock.release()
+            self._sensor_lock.release()
+        print(f"State saved to {filename}")
+
+    async def check_alerts(self):
+        """
+        Runs forever raising alerts for sensors which have gone quiet
+        """
+        while self._receiving:
+            await asyncio.sleep(Constants.ALERT_CHECK_SECONDS)
+            self._sensor_lock.acquire(True)
+            alerts = self._rules.check_stale(self._devices)
+            self._sensor_lock.release()
+            await self.broadcast_alerts(alerts)
+
+    async def broadcast_alerts(self, alerts):
+        """
+        Sends each alert event to all clients
+        """
+        for alert in alerts:
+            print(f"Alert {alert['rule']} {alert['state']} for {alert['sensor_name']}")
+        if len(alerts):
+            await self.broadcast_message(
+                [{ 'cmd': 'alert', 'data': alert } for alert in alerts]
+            )
+
+    async def update_federated_sensors(self, devices):
+        """
+        Replaces the devices with the merged map from the upstream gateways
+        """
+        self._sensor_lock.acquire(True)
+        changed = self._devices.replace(devices)
+        self._sensor_lock.release()
+        # The rules skip readings they have already seen
+        alerts = []
+        for addr in changed:
+            device = self._devices.get(addr)
+            if device is None:
+                continue
+            self._rules.watch(device)
+            if device.last_reading is not None:
+                alerts += self._rules.add(device, device.last_reading)
+        await self.broadcast_alerts(alerts)
+        await self.broadcast_sensors()
+        await self.profile_cycle_done()
+
+    def start_profile(self, cycles, client_id=None, interval=None):
+        """
+        Starts profiling the next number of cycles. The report is sent to
+        the given client, or printed if there is none.
+        Returns False if a profile is already running.
+        """
+        if self._profiler is not None:
+            return False
+        print(f"Profiling the next {cycles} cycles")
+        if interval is None:
+            self._profiler = SamplingProfiler()
+        else:
+            self._profiler = SamplingProfiler(interval=interval)
+        self._profile_cycles = cycles
+        self._profile_client = client_id
+        self._profiler.start()
+        return True
+
+    async def profile_cycle_done(self):
+        """
+        Counts a finished cycle towards any running profile, reporting it
+        once enough cycles have been profiled
+        """
+        if self._profiler is None:
+            return
+        self._profile_cycles -= 1
+        if self._profile_cycles > 0:
+            return
+        profiler = self._profiler
+        client_id = self._profile_client
+        self._profiler = None
+        profiler.stop()
+        report = profiler.report()
+        if client_id is None:
+            print_report(report)
+        elif client_id in self._clients:
+            await self.send_messages(
+                { 'cmd': 'debug', 'data': report },
+                client_id
+            )
+
+    async def broadcast_message(self, message, client_id=None, encoded=None):
         """
         Broadcasts a message to all or the selected client ID
         """
+        with metrics.timer('broadcast_seconds'):
+            await self.send_messages(message, client_id, encoded)
+
+    async def send_messages(self, message, client_id=None, encoded=None):
+        """
+        Sends one or more message dictionaries to all or the selected client
+        IDs. Each message is encoded once for each encoding in use, unless
+        encoded already holds the list of payloads for that encoding.
+        """
         # Assume we want to iterate through several messages
-        if not isinstance(message_json, list):
-            message_json = [message_json]
+        if not isinstance(message, list):
+            message = [message]
 
         keys = None
         if client_id is None:
             self._client_lock.acquire(True)
-            keys = self._clients.keys()
+            keys = list(self._clients.keys())
             self._client_lock.release()
         else:
             if isinstance(client_id, list):
@@ -175,17 +453,33 @@ class SensorServer:
             else:
                 keys = [client_id]
 
+        given = encoded or {}
+        encoded = {}
         for key in keys:
+            self._client_lock.acquire(True)
+            client = self._clients.get(key)
+            client_encoding = self._encodings.get(key)
+            self._client_lock.release()
+            if client is None:
+                # The client left while an earlier send was waiting
+                continue
             try:
-                self._client_lock.acquire(True)
-                client = self._clients[key]
-                self._client_lock.release()
-                for msg in message_json:
+                if client_encoding not in encoded:
+                    if client_encoding in given:
+                        encoded[client_encoding] = [
+                            encoding.counted(m, client_encoding)
+                            for m in given[client_encoding]
+                        ]
+                    else:
+                        encoded[client_encoding] = [
+                            encoding.encode(m, client_encoding) for m in message
+                        ]
+                for msg in encoded[client_encoding]:
                     # print(f"Sending {msg} to {key}")
                     await client.send(msg)
-            except Exception as e:
+            except websockets.exceptions.ConnectionClosed:
+                # Its handler removes it, the other clients still get the message
                 print("Failed to send message to client:", key)
-                raise e
 
     async def broadcast_settings(self, client_id=None):
         """
@@ -197,58 +491,242 @@ class SensorServer:
             'data': self._settings
         }
         self._settings_lock.release()
-        await self.broadcast_message(dumps(message), client_id)
+        await self.broadcast_message(message, client_id)
 
     async def broadcast_sensors(self, client_id=None):
         """
         Broadcasts the latest sensor information to the clients
         """
+        # Anything broadcast may have changed what HTTP clients should see
+        self._snapshot_cache = {}
         self._sensor_lock.acquire(True)
         message = {
             'cmd': 'sensors',
-            'data': self._devices
+            'data': self._devices.as_dict()
         }
+        # JSON clients get the registry's cached text rather than a fresh
+        # encoding of every device
+        text = '{"cmd": "sensors", "data": ' + self._devices.as_json() + '}'
         self._sensor_lock.release()
-        await self.broadcast_message(dumps(message), client_id)
+        await self.broadcast_message(message, client_id, { Encodings.JSON: [text] })
+
+    async def broadcast_stats(self, client_id=None):
+        """
+        Sends the current metrics to the clients
+        """
+        message = {
+            'cmd': 'stats',
+            'data': metrics.snapshot()
+        }
+        await self.send_messages(message, client_id)
+
+    def serve_metrics(self, path, headers):
+        """
+        Serves the metrics in the Prometheus text format
+        """
+        return HttpResponse(
+            200,
+            metrics.render(),
+            'text/plain; version=0.0.4'
+        )
+
+    def serve_sensors(self, path, headers):
+        """
+        Serves all sensors at /sensors, or one at /sensors/<address>, where
+        the address may be given with or without colons, or by sensor name
+        """
+        key = unquote(path[len('/sensors'):].strip('/'))
+        cache = self._snapshot_cache
+        if key not in cache:
+            self._sensor_lock.acquire(True)
+            if not len(key):
+                cache[key] = CachedResponse(self._devices.as_json())
+            else:
+                device = self._devices.find(key)
+                if device is not None:
+                    cache[key] = CachedResponse(device.as_json())
+            self._sensor_lock.release()
+        if key not in cache:
+            return HttpResponse(404, 'Unknown sensor\n')
+        return cache[key].respond(headers)
 
-    async def handle_message(self, message):
+    async def handle_message(self, message, client_id=None):
         """
         Handles incoming message and returns a response to be
         sent to the client
         """
         cmd = message['cmd']
-        data = message['data']
-        if cmd == 'settings':
+        data = message.get('data')
+        if cmd == 'stats':
+            # The client wants to see where the time is going
+            await self.broadcast_stats(client_id)
+
+        elif cmd == 'alerts':
+            # The client wants the alerts which are currently firing
+            await self.send_messages(
+                { 'cmd': 'alerts', 'data': self._rules.active_alerts() },
+                client_id
+            )
+
+        elif cmd == 'debug':
+            # The client wants a profile of the next few cycles
+            data = data or {}
+            if not self.start_profile(
+                data.get('cycles', 1),
+                client_id,
+                data.get('interval')
+            ):
+                await self.send_messages(
+                    { 'cmd': 'debug', 'data': { 'error': 'Already profiling' } },
+                    client_id
+                )
+
+        elif cmd == 'settings':
             # The client wants to update the current settings
             print("Updating settings")
+            # Keep defaults for any settings the client left out, and this
+            # run's overrides
+            settings = {
+                **SensorServer.default_settings(),
+                **data,
+                **self._overrides
+            }
             self._settings_lock.acquire(True)
-            self._settings = data
+            rules_changed = settings['rules'] != self._settings['rules']
+            snapshot_changed = settings['snapshot_minutes'] != self._settings['snapshot_minutes']
             self._settings_lock.release()
+            rules = None
+            # Check the new settings and rules before accepting any of them
+            try:
+                SensorServer.check_settings(settings)
+                if rules_changed:
+                    rules = RulesEngine(settings['rules'])
+            except Exception as e:
+                print(f"Rejected invalid settings: {e!r}")
+                await self.send_messages(
+                    { 'cmd': 'settings_rejected', 'data': { 'error': f"Invalid settings: {e!r}" } },
+                    client_id
+                )
+                await self.broadcast_settings(client_id)
+                return
+            self._settings_lock.acquire(True)
+            self._settings = settings
+            self._settings_lock.release()
+            if rules is not None:
+                self._rules = rules
+                for device in self._devices.values():
+                    self._rules.watch(device)
+            if snapshot_changed:
+                if self._snapshot_task is not None:
+                    self._snapshot_task.cancel()
+                    self._snapshot_task = None
+                if settings['snapshot_minutes']:
+                    self._snapshot_task = self._loop.create_task(self.save_snapshots())
             print("Settings updated -> broadcasting")
-            self.broadcast_settings()
+            await self.broadcast_settings()
 
-        elif cmd  == 'sensors':
-            # The client has made changes to all sensors
-            print("Updating sensors")
-            self._sensor_lock.acquire(True)
-            self._devices = data
-            self._sensor_lock.release()
-            print("Sensors updated -> broadcasting")
-            self.broadcast_sensors()
+        elif cmd in ('patch', 'sensors', 'single_sensor'):
+            # The client has made changes to some sensors
+            patches = self.patches_from_message(cmd, data)
+            if self._federation is not None:
+                # The gateway serving each sensor owns its details
+                for patch in patches:
+                    rejection = await self._federation.forward_patch(patch, client_id)
+                    if rejection is not None:
+                        await self.reject_patch(client_id, rejection)
+            else:
+                await self.apply_patches(patches, client_id)
 
-        elif cmd == 'single_sensor':
-            # The client has made changes to one sensor
-            addr = data['index']
-            sensor_data = data['sensor']
-            self._sensor_lock.acquire(True)
-            if addr in self._sensors:
-                self._sensors[addr]['sensor_name'] = sensor_data['sensor_name']
-                self._sensors[addr]['active'] = sensor_data['active']
-            self._sensor_lock.release()
+        else:
+            print("Unknown command:", cmd)
+
+    def patches_from_message(self, cmd, data):
+        """
+        Gets the list of patches asked for by a message. A patch is given
+        as { 'addr', 'changes', 'version' }, or a list of them. The older
+        'sensors' and 'single_sensor' messages send whole devices, so their
+        editable fields become patches without a version.
+        """
+        if cmd == 'patch':
+            return data if isinstance(data, list) else [data]
+        if cmd == 'single_sensor':
+            data = { data['index']: data['sensor'] }
+        patches = []
+        self._sensor_lock.acquire(True)
+        for addr, sensor in data.items():
+            device = self._devices.get(addr)
+            if device is None:
+                continue
+            changes = {
+                field: sensor[field]
+                for field in RegistryConstants.EDITABLE_FIELDS
+                if field in sensor and sensor[field] != getattr(device, field)
+            }
+            if len(changes):
+                patches.append({ 'addr': addr, 'changes': changes })
+        self._sensor_lock.release()
+        return patches
+
+    async def apply_patches(self, patches, client_id=None):
+        """
+        Applies the patches, all of them or none. If any is rejected, the
+        client is sent the reason and the device as it now is. Otherwise
+        only the changes are broadcast to every client.
+        """
+        if not len(patches):
+            return
+        self._settings_lock.acquire(True)
+        sensor_file = self._settings['sensor_file']
+        self._settings_lock.release()
 
+        self._sensor_lock.acquire(True)
+        rejection = None
+        for patch in patches:
+            addr = patch.get('addr')
+            reason = self._devices.check_patch(
+                addr,
+                patch.get('changes'),
+                patch.get('version')
+            )
+            if reason is not None:
+                device = self._devices.get(addr)
+                rejection = {
+                    'addr': addr,
+                    'reason': reason,
+                    'device': device.as_dict() if device is not None else None
+                }
+                break
+        applied = []
+        if rejection is None:
+            for patch in patches:
+                applied.append({
+                    'addr': patch['addr'],
+                    'version': self._devices.patch(patch['addr'], patch['changes']),
+                    'changes': patch['changes']
+                })
+            SensorServer.save_devices(self._devices, sensor_file)
+        self._sensor_lock.release()
 
+        if rejection is not None:
+            await self.reject_patch(client_id, rejection)
         else:
-            print("Unknown command:", cmd)
+            self._snapshot_cache = {}
+            await self.broadcast_message({ 'cmd': 'sensor_patch', 'data': applied })
+
+    async def reject_patch(self, client_id, rejection):
+        """
+        Tells the client which asked for a patch why it was rejected, if it
+        is still connected
+        """
+        print(f"Rejected patch for {rejection['addr']}: {rejection['reason']}")
+        self._client_lock.acquire(True)
+        connected = client_id is None or client_id in self._clients
+        self._client_lock.release()
+        if connected:
+            await self.send_messages(
+                { 'cmd': 'patch_rejected', 'data': rejection },
+                client_id
+            )
 
     async def new_client(self, client, path):
         """
@@ -258,10 +736,20 @@ class SensorServer:
         client_id = self._client_count
         self._client_count += 1
         self._clients[client_id] = client
-        print(f"New client {client_id}: {client.remote_address}")
+        # The encoding is chosen as the websocket subprotocol
+        client_encoding = client.subprotocol or Encodings.JSON
+        self._encodings[client_id] = client_encoding
+        print(f"New client {client_id}: {client.remote_address} ({client_encoding})")
         self._client_lock.release()
 
         try:
+            if client_encoding != Encodings.JSON:
+                # Binary clients need the key list to decode messages
+                await client.send(encoding.encode(
+                    { 'cmd': 'keys', 'data': KEYS },
+                    client_encoding,
+                    replace_keys=False
+                ))
             await self.broadcast_settings(client_id)
             await self.broadcast_sensors(client_id)
             # await self.broadcast_settings()
@@ -274,12 +762,12 @@ class SensorServer:
                     json_str = await client.recv()
                     json_data = None
                     try:
-                        json_data = loads(json_str)
+                        json_data = encoding.decode(json_str, client_encoding)
                     except:
                         print("Error parsing:", json_str)
 
                     if json_data is not None:
-                        await self.handle_message(json_data)
+                        await self.handle_message(json_data, client_id)
 
                     # print(json_str)
                     # await client.send(json_str * 2)
@@ -321,6 +809,7 @@ class SensorServer:
         """
         self._client_lock.acquire(True)
         del self._clients[client_id]
+        del self._encodings[client_id]
         self._client_lock.release()
 
     @staticmethod
@@ -338,61 +827,46 @@ class SensorServer:
             print(f"Settings saved with index {settings['save_id']}")
 
     @staticmethod
-    async def find_new_xiaomi_devices(existing, duration):
+    async def find_new_xiaomi_devices(existing, duration, scheduler):
         """
-        Finds all new xiaomi devices by name and address.
+        Finds all new xiaomi devices by name and address on every adapter.
         Assigns a new name to the device in the form:
         Sensor xx, where xx is the next available index
 
-        Note: We use another script via subprocess, as it
+        Note: Each adapter uses another script via subprocess, as it
         would otherwise block and prevent asyncio from running.
         Why this happens, I don't know!
         """
-        x_devices = {}
-        args = ['./find_new_xdevices.py', '-d', str(duration)]
-        if len(existing):
-            args += ['-e'] + list(existing.keys())
-        proc = await asyncio.create_subprocess_exec(
-            *args,
-            stdout=asyncio.subprocess.PIPE
-        )
-        try:
-            data = await asyncio.wait_for(
-                proc.communicate(),
-                timeout=180
-            )
-        except asyncio.TimeoutError:
-            print("Finding devices timed out")
-
-        if proc.returncode == 0:
-            x_devices = loads(data[0])
+        with metrics.timer('discovery_seconds'):
+            x_devices = await scheduler.discover(list(existing.keys()), duration)
 
         print('--------------------------')
         print(x_devices)
         print('--------------------------')
         return x_devices
 
-
     @staticmethod
     def save_devices(devices, filename):
         """
         Saves the device settings to the given file name
         """
-        if isinstance(devices, dict):
+        if isinstance(devices, DeviceRegistry):
+            devices = devices.as_indented_json()
+        elif isinstance(devices, dict):
             devices = dumps(devices, sort_keys=True, indent=4)
         else:
             print("We got dis: ", devices)
-            raise Exception("Device information must be a dictionary")
+            raise Exception("Device information must be a dictionary or registry")
         with open(filename, 'w') as f:
             f.write(devices)
 
     @staticmethod
-    def load_settings(filename):
+    def default_settings():
         """
-        Loads the configuration settings for scanning and gathering
+        Gets the default settings, used for any missing from a file or
+        from a client
         """
-        # Create some defaults
-        settings = {
+        return {
             'interval': {
                 'mins': 2, 'secs': 30
             },
@@ -400,15 +874,66 @@ class SensorServer:
             'save_id': 0,
             'scan_seconds': 5,
             'max_attempts': 3,
-            'next_scan': datetime.now().isoformat()
+            'next_scan': datetime.now().isoformat(),
+            'adapters': [
+                { 'name': 'hci0', 'max_connections': 1 }
+            ],
+            'backend': { 'type': 'hci' },
+            'upstreams': [],
+            'http_port': 9043,
+            'backfill_minutes': 60,
+            'stats_windows': { '1h': 60, '24h': 1440 },
+            'stats_alpha': 0.2,
+            'rules': [],
+            'compression': True,
+            'snapshot_file': 'wss_state.pickle',
+            'snapshot_minutes': 5,
+            'mqtt': None
         }
+
+    @staticmethod
+    def check_settings(settings):
+        """
+        Checks the numeric settings, raising an exception describing the
+        first which is not valid
+        """
+        def number(key, value, minimum=0, allow_none=False):
+            if value is None and allow_none:
+                return
+            if not isinstance(value, (int, float)) or isinstance(value, bool) \
+                or value < minimum:
+                raise Exception(f"{key} must be a number of at least {minimum}")
+
+        interval = settings['interval']
+        if not isinstance(interval, dict):
+            raise Exception("interval must have mins and secs")
+        number('interval mins', interval.get('mins'))
+        number('interval secs', interval.get('secs'))
+        if interval['mins'] * 60 + interval['secs'] <= 0:
+            raise Exception("interval must be longer than 0")
+        number('scan_seconds', settings['scan_seconds'])
+        number('max_attempts', settings['max_attempts'], 1)
+        number('backfill_minutes', settings['backfill_minutes'], allow_none=True)
+        number('stats_alpha', settings['stats_alpha'])
+        if settings['stats_alpha'] > 1:
+            raise Exception("stats_alpha must be no more than 1")
+        number('snapshot_minutes', settings['snapshot_minutes'])
+        number('http_port', settings['http_port'])
+
+    @staticmethod
+    def load_settings(filename):
+        """
+        Loads the configuration settings for scanning and gathering
+        """
+        settings = SensorServer.default_settings()
         loaded = False
         if path.isfile(filename):
             try:
                 with open(filename, 'r') as f:
                     settings_json = f.read()
-                    settings = loads(settings_json)
-                    print(f"Loaded settings: {settings_json}")
+                    # Keep defaults for any settings added since the file was saved
+                    settings = { **settings, **loads(settings_json) }
+                    print(f"Loaded settings from {filename}")
                     loaded = True
             except:
                 pass
@@ -428,7 +953,7 @@ class SensorServer:
                 with open(filename, 'r') as f:
                     devices_json = f.read()
                     devices = loads(devices_json)
-                    print(f"Found devices: {devices_json}")
+                    print(f"Found {len(devices)} devices in {filename}")
             except Exception as e:
                 print(f"Failed to open {filename}")
                 raise e
@@ -436,118 +961,338 @@ class SensorServer:
         return devices
 
     @staticmethod
-    async def gather_sensor_readings(devices, max_attempts):
+    def load_snapshot(filename):
         """
-        Connects to each device and gathers the readings
+        Loads the state saved by write_snapshot, or None if there is no
+        usable snapshot
         """
-        keys = devices.keys()
-
-        for addr in keys:
-            device = devices[addr]
-            attempts = 0
-            readings_complete = False
-            while attempts < max_attempts and not readings_complete:
-                attempts += 1
-                result = ExitCodes.OK
-                try:
-                    print(f"Attempting to read from sensor {device['sensor_name']}...")
-                    proc = await asyncio.create_subprocess_exec(
-                        './get_sensor_data.py',
-                        device['addr'],
-                        stdout=asyncio.subprocess.PIPE
-                    )
-                    reading = await asyncio.wait_for(
-                        proc.communicate(),
-                        timeout=180
-                    )
-                except concurrent.futures._base.TimeoutError:
-                    result = ExitCodes.USER_CANCELLED
-                except KeyboardInterrupt:
-                    result = ExitCodes.USER_CANCELLED
-                except TimeoutError:
-                    result = ExitCodes.TIMED_OUT
-                except Exception as e:
-                    raise e
-
-                if proc.returncode == ExitCodes.OK:
-                    print('Data -> ', reading)
-                    reading = loads(reading[0])
-                    print('Return code -> ', proc.returncode)
-                    devices[addr]['last_reading'] = reading
-                    SensorServer.update_histories(devices[addr], reading)
-                    print(f"Device {device['sensor_name']} ({device['addr']}) -> {dumps(reading, sort_keys=True, indent=4)}")
-                    readings_complete = True
-                elif proc.returncode == ExitCodes.INVALID_ARGS:
-                    raise RuntimeError('The script requires an address!')
-                elif proc.returncode == ExitCodes.USER_CANCELLED:
-                    print("User cancelled scan.")
-                    readings_complete = True
-                elif proc.returncode == ExitCodes.TIMED_OUT:
-                    print(f"Data wasn't sent ({attempts}/{max_attempts})")
-                elif proc.returncode == ExitCodes.DISCONNECTED:
-                    print(f"Failed to connect. Perhaps the device is busy elsewhere.")
-                    attempts = max_attempts
-                else:
-                    print("Unknown exception.")
-                    attempts = max_attempts
-
-
-
-
-                # client = Lywsd02Client(device['addr'])
-                # reading = {
-                #     'timestamp': datetime.now().isoformat(),
-                #     'temperature': client.temperature,
-                #     'humidity': client.humidity,
-                #     'battery': client.battery
-                # }
-
-                # except KeyboardInterrupt:
-
+        if not path.isfile(filename):
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                state = pickle.load(f)
+        except Exception as e:
+            print(f"Ignoring unreadable snapshot {filename}: {e}")
+            return None
+        if state.get('version') != Constants.SNAPSHOT_VERSION:
+            print(f"Ignoring snapshot {filename} from another version")
+            return None
+        # History files are checked against their recorded sizes before
+        # these are trusted
+        SensorServer.history_ends.update(state.get('history_ends', {}))
+        return state
 
-                # except TimeoutError:
+    @staticmethod
+    def write_snapshot(state, filename):
+        """
+        Writes the state to the snapshot file. It is written alongside and
+        then moved into place, so a crash never leaves half a snapshot.
+        """
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        replace(temp_filename, filename)
 
+    @staticmethod
+    async def read_sensor(adapter, device, max_attempts, since=None):
+        """
+        Reads a single device through the given adapter, retrying up to
+        max_attempts times, along with any on-device history after since.
+        Returns the ReadResult, or None if it failed.
+        """
+        labels = { 'addr': device.addr }
+        attempts = 0
+        while attempts < max_attempts:
+            attempts += 1
+            print(f"Attempting to read from sensor {device.sensor_name} on {adapter.name}...")
+            start = monotonic()
+            try:
+                outcome = await adapter.read(device.addr, since)
+                result, reading = outcome.code, outcome.reading
+            except KeyboardInterrupt:
+                outcome = None
+                result, reading = ExitCodes.USER_CANCELLED, None
+            latency = monotonic() - start
+            adapter.link(device.addr).record(latency, result == ExitCodes.OK)
+            SensorServer.record_attempt(labels, result, outcome, latency)
+            if result != ExitCodes.TIMED_OUT or attempts == max_attempts:
+                metrics.observe('sensor_attempts', attempts, labels)
 
-                # except BTLEDisconnectError:
+            if result == ExitCodes.OK:
+                print(f"Device {device.sensor_name} ({device.addr}) -> {dumps(reading, sort_keys=True, indent=4)}")
+                return outcome
+            elif result == ExitCodes.INVALID_ARGS:
+                raise RuntimeError('The script requires an address!')
+            elif result == ExitCodes.USER_CANCELLED:
+                print("User cancelled scan.")
+                return None
+            elif result == ExitCodes.TIMED_OUT:
+                print(f"Data wasn't sent ({attempts}/{max_attempts})")
+            elif result == ExitCodes.DISCONNECTED:
+                print(f"Failed to connect. Perhaps the device is busy elsewhere.")
+                return None
+            else:
+                print("Unknown exception.")
+                return None
+        return None
 
-                #     # Force an early end to the loop - Waiting for a connection is time consuming
+    @staticmethod
+    def record_attempt(labels, result, outcome, latency):
+        """
+        Records the metrics for a single read attempt. Where the backend
+        cannot split the time between connecting and reading, all of it
+        is counted as reading.
+        """
+        metrics.inc(
+            'sensor_results_total',
+            { **labels, 'result': ExitCodes.name(result) }
+        )
+        if outcome is not None and outcome.connect_seconds is not None:
+            metrics.observe('sensor_connect_seconds', outcome.connect_seconds, labels)
+        if outcome is not None and outcome.read_seconds is not None:
+            metrics.observe('sensor_read_seconds', outcome.read_seconds, labels)
+        elif result == ExitCodes.OK:
+            metrics.observe('sensor_read_seconds', latency, labels)
 
+    @staticmethod
+    async def gather_sensor_readings(devices, max_attempts, scheduler,
+        backfill=None, on_reading=None):
+        """
+        Connects to each device and gathers the readings, sharing the
+        devices between the scheduler's adapters. Where a device's history
+        has a gap of at least the backfill timedelta, the missing records
+        are recovered from the device's own history. on_reading is an
+        optional coroutine function called with the address and the list
+        of new readings, oldest first, for each device read.
+        """
+        async def read_one(adapter, addr):
+            since = SensorServer.backfill_since(devices[addr], backfill)
+            outcome = await SensorServer.read_sensor(
+                adapter,
+                devices[addr],
+                max_attempts,
+                since
+            )
+            if outcome is not None:
+                devices.set_reading(addr, outcome.reading)
+                if on_reading is not None:
+                    await on_reading(
+                        addr,
+                        outcome.history + outcome.earlier + [outcome.reading]
+                    )
+                SensorServer.update_histories(
+                    devices[addr],
+                    outcome.reading,
+                    outcome.history,
+                    outcome.earlier
+                )
 
-                # except Exception as e:
-                #     # print(e)
-                #     # print(f"Failed to gather readings for {device['addr']}. Trying again...")
-                #     raise e
+        await scheduler.run_cycle(list(devices.keys()), read_one)
         return devices
 
     @staticmethod
-    def update_histories(device, new_reading):
+    def backfill_since(device, backfill):
+        """
+        Gets the time of the last reading in the device's history file if
+        it is at least backfill ago, otherwise None
+        """
+        if backfill is None:
+            return None
+        # The last reading is normally the end of the history, so only go
+        # to the file when it suggests there is a gap
+        last_reading = device.last_reading
+        if last_reading is not None and \
+            datetime.now() - datetime.fromisoformat(last_reading['timestamp']) < backfill:
+            return None
+        last_time = SensorServer.last_history_timestamp(device)
+        if last_time is None or datetime.now() - last_time < backfill:
+            return None
+        print(f"Backfilling {device.sensor_name} from {last_time.isoformat()}")
+        return last_time
+
+    @staticmethod
+    def load_history(device):
         """
-        Updates the history file for the given device
+        Loads the history file for the given device
         """
-        history_json = ""
         history = {}
-        if path.isfile(device['history_file']):
+        if path.isfile(device.history_file):
             try:
-                with open(device['history_file'], 'r') as f:
+                with open(device.history_file, 'r') as f:
                     history_json = f.read()
                     history = loads(history_json) if len(history_json) else {}
             except Exception as e:
                 print("Failed to open history file.")
                 raise e
+        return history
+
+    @staticmethod
+    def last_history_timestamp(device):
+        """
+        Gets the time of the last reading in the device's history file,
+        or None if there is no history
+        """
+        end = SensorServer.history_end(device.history_file)
+        if end is not None:
+            return datetime.fromisoformat(end)
+        history = SensorServer.load_history(device)
+        if not len(history):
+            return None
+        return datetime.fromisoformat(max(history.keys()))
+
+    @staticmethod
+    def update_histories(device, new_reading, backfilled=None, earlier=None):
+        """
+        Updates the history file for the given device, merging in any
+        backfilled readings and any readings taken since the last read
+        """
+        earlier = earlier or []
+        with metrics.timer('history_write_seconds'):
+            added = SensorServer.write_history(
+                device,
+                (backfilled or []) + earlier + [new_reading]
+            )
+        if backfilled:
+            count = max(added - 1 - len(earlier), 0)
+            print(f"Backfilled {count} readings for {device.sensor_name}")
+            metrics.inc('backfill_readings_total', { 'addr': device.addr }, count)
+
+    @staticmethod
+    def history_end(filename):
+        """
+        Gets the last timestamp in a history file, if it is known and the
+        file has not been changed since, otherwise None
+        """
+        end = SensorServer.history_ends.get(filename)
+        if end is None or not path.isfile(filename) or path.getsize(filename) != end[1]:
+            return None
+        return end[0]
+
+    @staticmethod
+    def write_history(device, readings):
+        """
+        Adds the readings to the device's history file, skipping any with
+        a timestamp already present. Returns the number added.
 
-        history[new_reading['timestamp']] = new_reading
-        with open(device['history_file'], 'w') as f:
-            f.write(dumps(history, sort_keys=True, indent=4))
+        Readings newer than everything in the file are appended, which
+        gives the same file as rewriting it, as the entries are sorted.
+        Otherwise the file is loaded, merged and rewritten.
+        """
+        filename = device.history_file
+        new = {}
+        for reading in readings:
+            new.setdefault(reading['timestamp'], reading)
+        end = SensorServer.history_end(filename)
+        if end is not None and len(new) and min(new) > end:
+            entries = dumps(new, sort_keys=True, indent=4)[2:-2]
+            with open(filename, 'r+b') as f:
+                # Replace the closing brace with the new entries
+                f.seek(-2, 2)
+                if f.read() == b'\n}':
+                    f.seek(-2, 2)
+                    f.write(f',\n{entries}\n}}'.encode())
+                    size = f.tell()
+                    SensorServer.history_ends[filename] = (max(new), size)
+                    return len(new)
+
+        history = SensorServer.load_history(device)
+        added = 0
+        for timestamp, reading in new.items():
+            if timestamp not in history:
+                history[timestamp] = reading
+                added += 1
+        text = dumps(history, sort_keys=True, indent=4)
+        with open(filename, 'w') as f:
+            f.write(text)
+        if len(history):
+            SensorServer.history_ends[filename] = (max(history), path.getsize(filename))
+        return added
 
 
 if __name__ == '__main__':
-    print(f"Starting server: {Constants.ADDR}:{Constants.PORT}")
+    parser = ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=Constants.PORT,
+        help='Provides the port to serve clients on.')
+    parser.add_argument('-H', '--http-port', type=int, default=None,
+        help='Provides the port to serve HTTP on, 0 to disable.')
+    parser.add_argument('-s', '--settings', type=str,
+        default=Constants.SETTINGS_FILENAME,
+        help='Provides the settings file name.')
+    parser.add_argument('-u', '--upstream', type=str, nargs='+', default=None,
+        help='Aggregates the sensors of the gateways at the given websocket '
+            'URIs, e.g. ws://gateway:9042, instead of reading sensors.')
+    parser.add_argument('-S', '--simulate', type=int, default=None,
+        help='Reads the given number of simulated sensors instead of '
+            'Bluetooth hardware.')
+    parser.add_argument('-r', '--replay', type=str, nargs='+', default=None,
+        metavar='FILE', help='Replays the given history files, or glob '
+            'patterns, as sensors instead of Bluetooth hardware.')
+    parser.add_argument('--speed', type=float, default=60.0,
+        help='Multiple of real time to replay history at.')
+    parser.add_argument('--fanout', type=int, default=1,
+        help='Number of sensors replaying each history file.')
+    parser.add_argument('-m', '--mqtt', type=str, default=None,
+        metavar='HOST[:PORT]', help='Publishes the readings to the given '
+            'MQTT broker as well.')
+    parser.add_argument('--profile', type=int, default=None, metavar='CYCLES',
+        help='Profiles the given number of cycles and prints the results.')
+    args = parser.parse_args()
+
+    # The command line only changes the settings for this run
+    settings = SensorServer.load_settings(args.settings)
+    overrides = {}
+    if args.http_port is not None:
+        overrides['http_port'] = args.http_port
+    if args.upstream is not None:
+        overrides['upstreams'] = args.upstream
+    if args.simulate is not None:
+        overrides['backend'] = { 'type': 'simulated', 'sensors': args.simulate }
+    if args.replay is not None:
+        overrides['backend'] = {
+            'type': 'replay',
+            'files': args.replay,
+            'speed': args.speed,
+            'fanout': args.fanout
+        }
+        # Read as often as the speed asks, so clients see readings at the
+        # replayed rate, down to the once a second the gather loop checks
+        interval = settings['interval']['mins'] * 60 + settings['interval']['secs']
+        overrides['interval'] = {
+            'mins': 0,
+            'secs': max(interval / args.speed, 1.0)
+        }
+    if 'backend' in overrides:
+        # Keep made up devices away from the real ones
+        kind = overrides['backend']['type']
+        for key in ('sensor_file', 'snapshot_file'):
+            overrides[key] = path.join(
+                path.dirname(settings[key]),
+                f"{kind}_{path.basename(settings[key])}"
+            )
+    if args.mqtt is not None:
+        host, _, port = args.mqtt.partition(':')
+        overrides['mqtt'] = {
+            **(settings['mqtt'] or {}),
+            'host': host,
+            'port': int(port) if port else MqttConstants.PORT
+        }
+
+    print(f"Starting server: {Constants.ADDR}:{args.port}")
     main_loop = asyncio.get_event_loop()
     server = SensorServer(
         Constants.ADDR,
-        Constants.PORT,
-        Constants.SETTINGS_FILENAME,
-        main_loop
+        args.port,
+        args.settings,
+        main_loop,
+        overrides=overrides
     )
+    if args.profile is not None:
+        server.start_profile(args.profile)
     main_loop.run_until_complete(server._server)
-    main_loop.run_forever()
+    main_loop.add_signal_handler(signal.SIGTERM, main_loop.stop)
+    try:
+        main_loop.run_forever()
+    except KeyboardInterrupt:
+        print('Keyboard interrupt hit')
+    finally:
+        server.save_snapshot()